@@ -1,13 +1,37 @@
 import os
 import json
+import base64
+import re
+import shlex
+import asyncio
 import time
+import select
+import stat
+import sys
+import tempfile
+import threading
 import uuid
+from fnmatch import fnmatch
 import panel as pn
 import paramiko
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from prometheus_client import Histogram
 from datetime import datetime
-from openai import OpenAI, OpenAIError
+from openai import AsyncOpenAI, OpenAI, OpenAIError
+try:
+    import tiktoken
+except ImportError:  # token counts fall back to a character-based estimate
+    tiktoken = None
 # If needed: from openai.error import OpenAIError
 
+# Helpers shared with the other apps: ../../shared in the repository, /opt/shared (on PYTHONPATH) in the image
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "shared"))
+from llm_common import (LATENCY_BUCKETS, MessageLog, StreamPreview, cached_create, current_session_id,  # noqa: E402
+                        setup_completion_cache, setup_metrics, setup_session_store, stats_tab)
+
 pn.extension()
 
 # -------------------------------------------------------------------
@@ -26,23 +50,54 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 if not OPENAI_API_KEY:
     raise ValueError("Please set the OPENAI_API_KEY environment variable.")
 
-# Initialize OpenAI client
-try:
-    client = OpenAI()
-except OpenAIError as e:
-    # If you want a Panel notification
-    pn.state.notifications.error(f"OpenAI initialization failed: {e}")
-    raise
-
-# Try to fetch model list
-model_ids = []
-try:
-    available_models = client.models.list()
-    # Filter for relevant models, e.g. only GPT-based
-    model_ids = [m.id for m in available_models if "gpt" in m.id]
-except OpenAIError as e:
-    # Fallback if listing fails
-    pass
+# Initialize the OpenAI client once per server process; every session shares it and its connection pool
+if "openai_client" not in pn.state.cache:
+    try:
+        pn.state.cache["openai_client"] = OpenAI()
+    except OpenAIError as e:
+        # If you want a Panel notification
+        pn.state.notifications.error(f"OpenAI initialization failed: {e}")
+        raise
+client = pn.state.cache["openai_client"]
+
+# Request handling is async so a slow completion doesn't block the server for other sessions
+if "async_openai_client" not in pn.state.cache:
+    pn.state.cache["async_openai_client"] = AsyncOpenAI()
+async_client = pn.state.cache["async_openai_client"]
+
+# The model list is cached on disk and refreshed in the background, so sessions start without a network call
+MODEL_CACHE_PATH = os.environ.get("MODEL_CACHE_PATH", os.path.join(tempfile.gettempdir(), "llmclitool_models.json"))
+MODEL_CACHE_TTL = float(os.environ.get("MODEL_CACHE_TTL", "3600"))
+
+def load_cached_models():
+    """Returns (model_ids, fetched_at) from the disk cache, or ([], 0) if there is none."""
+    try:
+        with open(MODEL_CACHE_PATH) as f:
+            cached = json.load(f)
+        return cached["models"], cached["fetched_at"]
+    except (OSError, ValueError, KeyError):
+        return [], 0
+
+def refresh_model_cache(on_refresh=None):
+    """Fetches the model list, writes it to the disk cache and passes it to `on_refresh`."""
+    try:
+        # Filter for relevant models, e.g. only GPT-based
+        fetched = sorted(m.id for m in client.models.list() if "gpt" in m.id)
+    except OpenAIError as e:
+        print(f"Could not refresh the model list: {e}")
+        fetched = []
+    finally:
+        pn.state.cache["model_refresh_lock"].release()
+    if not fetched:
+        return
+    tmp_path = f"{MODEL_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"models": fetched, "fetched_at": time.time()}, f)
+    os.replace(tmp_path, MODEL_CACHE_PATH)
+    if on_refresh:
+        on_refresh(fetched)
+
+model_ids, models_fetched_at = load_cached_models()
 
 # Provide fallback if the list is empty
 if not model_ids:
@@ -52,90 +107,1185 @@ if not model_ids:
 model_select = pn.widgets.Select(
     name='LLM Model',
     options=model_ids,
-    value="gpt-4o"
+    value="gpt-4o" if "gpt-4o" in model_ids else model_ids[0]
 )
 
+def update_model_options(fetched):
+    model_select.options = fetched if model_select.value in fetched else fetched + [model_select.value]
+
+# Refresh a stale cache in the background; one refresh per process at a time
+pn.state.cache.setdefault("model_refresh_lock", threading.Lock())
+if time.time() - models_fetched_at > MODEL_CACHE_TTL and pn.state.cache["model_refresh_lock"].acquire(blocking=False):
+    threading.Thread(target=refresh_model_cache, args=(update_model_options,), daemon=True).start()
+
 # SSH environment variables
 TARGET_HOST = os.environ.get("TARGET_HOST")
 TARGET_SSH_USER = os.environ.get("TARGET_SSH_USER")
 TARGET_SSH_PASS = os.environ.get("TARGET_SSH_PASS")
 TARGET_SSH_PORT = int(os.environ.get("TARGET_SSH_PORT", "22"))
 
+# Optional fleet of targets: path to a JSON inventory file, or the JSON itself (see load_inventory)
+TARGET_INVENTORY = os.environ.get("TARGET_INVENTORY", "")
+FLEET_WORKERS = int(os.environ.get("FLEET_WORKERS", "16"))  # hosts contacted at once by run_command_fleet
+
+# Stream assistant replies token by token (set STREAM_REPLIES=0 to wait for complete replies)
+STREAM_REPLIES = os.environ.get("STREAM_REPLIES", "1") != "0"
+
+# Messages kept rendered in the chat and terminal panes; older ones are behind "Show earlier"
+CHAT_WINDOW = int(os.environ.get("CHAT_WINDOW", "200"))
+
+# Remote command output: bytes kept in memory per command (head + tail) and live refresh interval
+COMMAND_OUTPUT_LIMIT = int(os.environ.get("COMMAND_OUTPUT_LIMIT", str(256 * 1024)))
+OUTPUT_UPDATE_INTERVAL = 0.1  # seconds, i.e. about 10 UI updates per second
+
+# Agent loop limits: model calls per user message, wall-clock seconds, and parallel tool workers
+AGENT_MAX_STEPS = int(os.environ.get("AGENT_MAX_STEPS", "8"))
+AGENT_MAX_SECONDS = float(os.environ.get("AGENT_MAX_SECONDS", "120"))
+TOOL_WORKERS = int(os.environ.get("TOOL_WORKERS", "16"))
+
+# Results of read-only commands are reused for a per-command TTL; COMMAND_CACHE_SIZE=0 disables the cache
+COMMAND_CACHE_SIZE = int(os.environ.get("COMMAND_CACHE_SIZE", "256"))
+
+# SFTP file tools: bytes returned per read_file call and entries per list_dir call
+READ_FILE_LIMIT = int(os.environ.get("READ_FILE_LIMIT", str(64 * 1024)))
+LIST_DIR_LIMIT = int(os.environ.get("LIST_DIR_LIMIT", "500"))
+
+# Background jobs: remote directory holding each job's pid, output spool and exit status
+JOB_DIR = os.environ.get("JOB_DIR", "/tmp/llmclitool-jobs")
+
+# Prompt token budget per model family (longest matching prefix wins); CONTEXT_BUDGET_TOKENS overrides it
+MODEL_CONTEXT_BUDGETS = {
+    "gpt-3.5": 12000,
+    "gpt-4": 6000,
+    "gpt-4-turbo": 32000,
+    "gpt-4o": 32000,
+    "gpt-4.1": 32000,
+}
+DEFAULT_CONTEXT_BUDGET = 32000
+CONTEXT_BUDGET_TOKENS = int(os.environ.get("CONTEXT_BUDGET_TOKENS", "0"))
+TOOL_OUTPUT_TOKEN_LIMIT = int(os.environ.get("TOOL_OUTPUT_TOKEN_LIMIT", "2000"))  # per command result sent to the LLM
+SUMMARY_TOKEN_LIMIT = int(os.environ.get("SUMMARY_TOKEN_LIMIT", "800"))  # rolling summary of folded turns
+MIN_TOOL_OUTPUT_TOKENS = 100  # what a result still gets when the budget is used up
+TOOL_MESSAGE_OVERHEAD = 100  # tokens of a tool message besides its output (JSON fields, exit status)
+ELISION_MARKER_TOKENS = 16  # the "... [n tokens elided] ..." line of a cut output
+
+# SSH pool sizing: transports per (host, port, user) and concurrent channels per transport
+SSH_MAX_TRANSPORTS = int(os.environ.get("SSH_MAX_TRANSPORTS", "4"))
+SSH_CHANNELS_PER_TRANSPORT = int(os.environ.get("SSH_CHANNELS_PER_TRANSPORT", "8"))
+SSH_KEEPALIVE_SECONDS = int(os.environ.get("SSH_KEEPALIVE_SECONDS", "30"))
+SSH_ACQUIRE_TIMEOUT = float(os.environ.get("SSH_ACQUIRE_TIMEOUT", "30"))
+
+# Chats are appended to one JSONL file per session under SESSION_DIR (empty disables) and
+# resumed from the ?session= URL parameter; fsync is batched every SESSION_FSYNC_INTERVAL seconds
+SESSION_DIR = os.environ.get("SESSION_DIR", os.path.join(tempfile.gettempdir(), "llmclitool_sessions"))
+SESSION_FSYNC_INTERVAL = float(os.environ.get("SESSION_FSYNC_INTERVAL", "0.5"))
+
 # -------------------------------------------------------------------
-# Persistent SSH Client
+# Target Inventory
 # -------------------------------------------------------------------
-persistent_ssh_client = None
-
-def get_ssh_client():
-    global persistent_ssh_client
-    if persistent_ssh_client is None:
-        persistent_ssh_client = paramiko.SSHClient()
-        persistent_ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        persistent_ssh_client.connect(
-            hostname=TARGET_HOST,
-            port=TARGET_SSH_PORT,
-            username=TARGET_SSH_USER,
-            password=TARGET_SSH_PASS,
-        )
-    return persistent_ssh_client
+def make_target(name, host, port=None, user=None, password=None, groups=()):
+    """A target is a plain dict; missing connection settings come from the TARGET_SSH_* variables."""
+    return {
+        "name": name,
+        "host": host,
+        "port": int(port or TARGET_SSH_PORT),
+        "user": user or TARGET_SSH_USER,
+        "password": password or TARGET_SSH_PASS,
+        "groups": list(groups),
+    }
+
+def load_inventory():
+    """
+    Reads TARGET_INVENTORY, e.g.
+
+        {"hosts": {"web1": {"host": "10.0.0.11"}, "web2": "10.0.0.12:2222", "db": {"host": "db", "user": "root"}},
+         "groups": {"web": ["web1", "web2"]}}
 
-def run_remote_command_shared(command: str, timeout: float = 5.0) -> str:
+    Host entries may override port, user and password. Returns {name: target}; the single
+    TARGET_HOST is added as a target of its own unless the inventory already names it.
     """
-    Executes the command on the remote host via a persistent SSH shell channel.
+    inventory = {"hosts": {}, "groups": {}}
+    if TARGET_INVENTORY.strip().startswith("{"):
+        inventory.update(json.loads(TARGET_INVENTORY))
+    elif TARGET_INVENTORY:
+        with open(TARGET_INVENTORY) as f:
+            inventory.update(json.load(f))
+
+    memberships = {}
+    for group, members in inventory["groups"].items():
+        for member in members:
+            memberships.setdefault(member, []).append(group)
+
+    targets = {}
+    for name, entry in inventory["hosts"].items():
+        if isinstance(entry, str):
+            host, _, port = entry.partition(":")
+            entry = {"host": host, "port": port or None}
+        targets[name] = make_target(name, entry.get("host", name), entry.get("port"), entry.get("user"),
+                                    entry.get("password"), memberships.get(name, ()))
+    if TARGET_HOST and not any(t["host"] == TARGET_HOST and t["port"] == TARGET_SSH_PORT for t in targets.values()):
+        targets.setdefault(TARGET_HOST, make_target(TARGET_HOST, TARGET_HOST))
+    return targets
+
+inventory = load_inventory()
+# The single-target tools (run_command, file tools, manual terminal) use TARGET_HOST, else the first inventory host
+default_target = next((t for t in inventory.values() if t["host"] == TARGET_HOST), None) \
+    or next(iter(inventory.values()), None) or make_target("target", TARGET_HOST)
+
+def select_targets(selector):
+    """
+    Resolves a selector to inventory targets: "all", or a comma-separated list of
+    host names, group names and shell-style patterns such as "web*".
+    """
+    selected = {}
+    for term in (part.strip() for part in (selector or "all").split(",")):
+        for name, target in inventory.items():
+            if term == "all" or fnmatch(name, term) or term in target["groups"]:
+                selected[name] = target
+    return list(selected.values())
+
+# -------------------------------------------------------------------
+# Metrics and Completion Cache (shared/llm_common.py)
+# -------------------------------------------------------------------
+def create_tool_metrics():
+    """Agent and SSH metrics, next to the shared completion metrics."""
+    return {
+        "agent_turn": Histogram("agent_turn_seconds", "Time from a user message to the final answer",
+                                buckets=LATENCY_BUCKETS),
+        "ssh_connect": Histogram("ssh_connect_seconds", "Time to establish a pooled SSH connection",
+                                 buckets=LATENCY_BUCKETS),
+        "ssh_exec": Histogram("ssh_exec_seconds", "Time from starting a remote command to its exit",
+                              buckets=LATENCY_BUCKETS),
+        "ssh_output_bytes": Histogram("ssh_output_bytes", "Output bytes produced by a remote command",
+                                      buckets=(0, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)),
+    }
+
+metrics = setup_metrics(create_tool_metrics)
+setup_completion_cache()
+
+# -------------------------------------------------------------------
+# Shared SSH Connection Pool
+# -------------------------------------------------------------------
+class PooledTransport:
+    """One authenticated SSH connection and the number of channels currently open on it."""
+
+    def __init__(self, client):
+        self.client = client
+        self.in_use = 0
+
+    @property
+    def transport(self):
+        return self.client.get_transport()
+
+    def healthy(self):
+        transport = self.transport
+        return transport is not None and transport.is_active() and transport.is_authenticated()
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:
+            pass
+
+
+class SSHConnectionPool:
+    """
+    Thread-safe pool of SSH connections keyed by (host, port, user).
+
+    Commands are run on channels multiplexed over a small number of transports, so
+    concurrent users don't pay a handshake per command. Each transport carries at most
+    `channels_per_transport` channels at once; callers wait for a free slot beyond that.
+    A transport that dies is dropped on its own and replaced on the next request,
+    without affecting channels running on the other transports.
+    """
+
+    def __init__(self, max_transports=SSH_MAX_TRANSPORTS, channels_per_transport=SSH_CHANNELS_PER_TRANSPORT,
+                 keepalive=SSH_KEEPALIVE_SECONDS, acquire_timeout=SSH_ACQUIRE_TIMEOUT):
+        self.max_transports = max_transports
+        self.channels_per_transport = channels_per_transport
+        self.keepalive = keepalive
+        self.acquire_timeout = acquire_timeout
+        self._cond = threading.Condition()
+        self._pools = {}     # key -> [PooledTransport]
+        self._pending = {}   # key -> number of connections being established
+
+    def _connect(self, host, port, user, password):
+        started = time.perf_counter()
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname=host, port=port, username=user, password=password, timeout=10)
+        client.get_transport().set_keepalive(self.keepalive)
+        metrics["ssh_connect"].observe(time.perf_counter() - started)
+        return PooledTransport(client)
+
+    def _acquire(self, host, port, user, password):
+        key = (host, port, user)
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                pool = self._pools.setdefault(key, [])
+                # Health check: forget idle transports that have gone away
+                for entry in [e for e in pool if not e.healthy() and e.in_use == 0]:
+                    pool.remove(entry)
+                    entry.close()
+
+                available = [e for e in pool if e.healthy() and e.in_use < self.channels_per_transport]
+                if available:
+                    entry = min(available, key=lambda e: e.in_use)
+                    entry.in_use += 1
+                    return entry
+
+                if len(pool) + self._pending.get(key, 0) < self.max_transports:
+                    self._pending[key] = self._pending.get(key, 0) + 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No free SSH channel to {host}:{port} after {self.acquire_timeout}s")
+                self._cond.wait(remaining)
+
+        # Connect outside the lock so other hosts and transports are not blocked by the handshake
+        try:
+            entry = self._connect(host, port, user, password)
+        except Exception:
+            with self._cond:
+                self._pending[key] -= 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._pending[key] -= 1
+            entry.in_use = 1
+            self._pools[key].append(entry)
+            self._cond.notify_all()
+        return entry
+
+    def _release(self, host, port, user, entry):
+        with self._cond:
+            entry.in_use -= 1
+            if not entry.healthy() and entry.in_use == 0:
+                pool = self._pools.get((host, port, user), [])
+                if entry in pool:
+                    pool.remove(entry)
+                entry.close()
+            self._cond.notify_all()
+
+    @contextmanager
+    def transport(self, host, port, user, password):
+        """Borrow one channel slot on a pooled transport for the duration of the block."""
+        entry = self._acquire(host, port, user, password)
+        try:
+            yield entry.transport
+        finally:
+            self._release(host, port, user, entry)
+
+    @contextmanager
+    def channel(self, host, port, user, password):
+        """
+        Open a session channel on a pooled transport and close it afterwards.
+        If the transport turns out to be dead when opening the channel, it is discarded
+        and the channel is opened once more on a fresh connection.
+        """
+        for attempt in range(2):
+            with self.transport(host, port, user, password) as transport:
+                try:
+                    channel = transport.open_session()
+                except (paramiko.SSHException, EOFError, OSError):
+                    transport.close()
+                    if attempt:
+                        raise
+                    continue
+                try:
+                    yield channel
+                finally:
+                    channel.close()
+                return
+
+
+if "ssh_pool" not in pn.state.cache:
+    pn.state.cache["ssh_pool"] = SSHConnectionPool()
+ssh_pool = pn.state.cache["ssh_pool"]
+
+# Process-wide bounded worker pool for blocking paramiko calls; it also runs the tool calls of one agent step in parallel
+if "tool_executor" not in pn.state.cache:
+    pn.state.cache["tool_executor"] = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+tool_executor = pn.state.cache["tool_executor"]
+
+class OutputWindow:
+    """
+    Collects a command's output but keeps only the first and last `limit // 2` bytes,
+    counting what was dropped in between, so a runaway command can't grow memory without bound.
+    """
+
+    def __init__(self, limit=COMMAND_OUTPUT_LIMIT):
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+
+    @property
+    def total_bytes(self):
+        return len(self.head) + len(self.tail) + self.dropped
+
+    def append(self, data):
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self.tail += data
+            excess = len(self.tail) - self.tail_limit
+            if excess > 0:
+                del self.tail[:excess]
+                self.dropped += excess
+
+    def text(self):
+        head = self.head.decode("utf-8", errors="ignore")
+        tail = self.tail.decode("utf-8", errors="ignore")
+        if not self.dropped:
+            return head + tail
+        return f"{head}\n... [{self.dropped} bytes omitted] ...\n{tail}"
+
+ANSI_ESCAPE = re.compile(r"\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[()][A-Za-z0-9]|[@-Z\\-_=>])")
+CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+MIN_REPEATS = 3  # identical consecutive lines before they are folded into one
+
+def compact_output(text: str) -> str:
+    """
+    Normalizes terminal output: drops ANSI escape sequences, applies backspaces and
+    carriage-return redraws (a progress bar ends up as its final state), and folds runs of
+    identical lines into the line plus a "[repeated N times]" marker.
+    """
+    text = ANSI_ESCAPE.sub("", text).replace("\r\n", "\n")
+    lines = []
+    for raw_line in text.split("\n"):
+        line = ""
+        for segment in raw_line.split("\r"):
+            if "\b" in segment:
+                kept = []
+                for char in segment:
+                    if char != "\b":
+                        kept.append(char)
+                    elif kept:
+                        kept.pop()
+                segment = "".join(kept)
+            line = segment + line[len(segment):]
+        lines.append(CONTROL_CHARS.sub("", line).rstrip())
+
+    compacted = []
+    i = 0
+    while i < len(lines):
+        run = 1
+        while i + run < len(lines) and lines[i + run] == lines[i]:
+            run += 1
+        if run >= MIN_REPEATS and lines[i]:
+            compacted.append(f"{lines[i]}  [repeated {run} times]")
+        elif run >= MIN_REPEATS:
+            compacted.append("")  # a block of blank lines becomes one
+        else:
+            compacted.extend(lines[i:i + run])
+        i += run
+    return "\n".join(compacted)
+
+def run_remote_command_shared(command: str, timeout: float = 5.0, on_output=None, target=None) -> dict:
+    """
+    Executes the command on the remote host over an exec channel from the shared SSH pool.
+    Completion is detected from the channel's EOF/exit status, and reads wait on select() instead of
+    sleeping, so a short command returns as soon as its output has been drained.
     If timeout <= 0, run indefinitely. Otherwise, forcibly send Ctrl-C after `timeout` seconds.
+    If given, `on_output` is called with the output so far at most every OUTPUT_UPDATE_INTERVAL
+    seconds while the command runs. Output is capped to a head/tail window (see OutputWindow)
+    and cleaned of terminal noise (see compact_output).
+
+    Runs on `target` (an inventory entry), by default on default_target.
+
+    Returns a dict with the combined output ("result"), the remote "exit_status"
+    (None if it could not be determined) and whether the command "timed_out".
     """
+    target = target or default_target
+    try:
+        with ssh_pool.channel(target["host"], target["port"], target["user"], target["password"]) as channel:
+            # Keep a PTY so programs behave as in a terminal and Ctrl-C can interrupt them
+            channel.get_pty(width=120, height=80)
+            channel.exec_command(command)
+            exec_started = time.perf_counter()
+
+            output = OutputWindow()
+            deadline = time.monotonic() + timeout if timeout > 0 else None
+            timed_out = False
+            last_update = 0.0
+            update_pending = False
+
+            while True:
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                if update_pending:
+                    wait = OUTPUT_UPDATE_INTERVAL if wait is None else min(wait, OUTPUT_UPDATE_INTERVAL)
+                select.select([channel], [], [], wait)
+                while channel.recv_ready():
+                    output.append(channel.recv(32768))
+                    update_pending = on_output is not None
+
+                # Push progress to the caller, throttled
+                if update_pending and time.monotonic() - last_update >= OUTPUT_UPDATE_INTERVAL:
+                    on_output(compact_output(output.text()))
+                    last_update = time.monotonic()
+                    update_pending = False
+
+                # The remote side closed its output: the command is done
+                if channel.eof_received and not channel.recv_ready():
+                    break
+
+                # If we have a positive timeout and exceeded it, send Ctrl-C and give it a moment to exit
+                if deadline is not None and time.monotonic() >= deadline:
+                    if timed_out:
+                        break
+                    timed_out = True
+                    channel.send("\x03")  # Ctrl-C
+                    deadline = time.monotonic() + 1.0
+
+            exit_status = None
+            if channel.status_event.wait(1.0):
+                exit_status = channel.recv_exit_status()
+
+            metrics["ssh_exec"].observe(time.perf_counter() - exec_started)
+            metrics["ssh_output_bytes"].observe(output.total_bytes)
+
+            result = compact_output(output.text()).strip()
+            return {
+                "result": result if result else "Command produced no output.",
+                "exit_status": exit_status,
+                "timed_out": timed_out,
+            }
+    except Exception as e:
+        return {"result": f"Error executing command: {e}", "exit_status": None, "timed_out": False}
+
+def format_exit_status(outcome: dict) -> str:
+    """Short human-readable note about how a command finished."""
+    if outcome["timed_out"]:
+        return "interrupted after timeout"
+    if outcome["exit_status"] is None:
+        note = "exit status unknown"
+    else:
+        note = f"exit status {outcome['exit_status']}"
+    if outcome.get("cached"):
+        note += f", cached result from {outcome['cached_age']:.0f}s ago"
+    return note
+
+# -------------------------------------------------------------------
+# Command Result Cache
+# -------------------------------------------------------------------
+# Read-only programs and how long (seconds) their output may be reused. Programs with
+# subcommands list the read-only ones; 0 means read-only but too volatile to cache.
+READ_ONLY_COMMANDS = {
+    "cat": 60, "head": 60, "tail": 10, "less": 60, "more": 60, "ls": 30, "tree": 30, "stat": 30,
+    "file": 60, "wc": 60, "grep": 30, "egrep": 30, "fgrep": 30, "find": 30, "du": 30, "df": 10,
+    "md5sum": 60, "sha256sum": 60, "readlink": 60, "realpath": 60, "pwd": 300, "basename": 300,
+    "dirname": 300, "echo": 300, "printf": 300, "sort": 60, "cut": 60, "tr": 60, "column": 60,
+    "jq": 60, "uname": 3600, "arch": 3600, "nproc": 3600,
+    "lsb_release": 3600, "whoami": 3600, "id": 300, "groups": 300, "which": 300, "whereis": 300,
+    "type": 300, "env": 60, "printenv": 60, "lscpu": 3600, "lsblk": 60, "findmnt": 60, "ip": 30,
+    "ifconfig": 30, "getent": 300, "dpkg": 300, "rpm": 300, "ps": 5, "free": 5, "uptime": 5,
+    "netstat": 5, "ss": 5, "lsof": 5, "w": 5, "who": 5, "last": 30, "journalctl": 5, "dmesg": 5,
+    "date": 0, "top": 0, "sleep": 0, "true": 0,
+}
+READ_ONLY_SUBCOMMANDS = {
+    "git": ({"status", "log", "diff", "show", "rev-parse", "ls-files", "blame"}, 10),
+    "systemctl": ({"status", "list-units", "list-unit-files", "is-active", "is-enabled", "show", "cat"}, 5),
+    "docker": ({"ps", "images", "inspect", "logs", "version", "info"}, 5),
+    "apt": ({"list", "show", "search", "policy"}, 300),
+    "pip": ({"list", "show", "freeze"}, 300),
+}
+# Options that make an otherwise read-only program write, delete or run other programs
+MUTATING_OPTIONS = {
+    "find": {"-delete", "-exec", "-execdir", "-ok", "-okdir", "-fprint", "-fprint0", "-fprintf", "-fls"},
+    "sort": {"-o", "--output"},
+    "tree": {"-o"},
+    "less": {"-o", "-O", "--log-file", "--LOG-FILE"},
+    "file": {"-C", "--compile"},
+    "git": {"--output"},
+    "ip": {"add", "del", "delete", "set", "flush", "change", "replace", "exec", "-batch"},
+    "ss": {"-K", "--kill"},
+    "dpkg": {"-i", "--install", "--unpack", "-r", "--remove", "-P", "--purge", "--configure",
+             "--set-selections", "--clear-selections", "--add-architecture", "--remove-architecture",
+             "--update-avail", "--merge-avail", "--clear-avail", "-A", "--record-avail"},
+    "dmesg": {"-c", "-C", "--clear", "--read-clear", "-D", "--console-off", "-E", "--console-on",
+              "-n", "--console-level"},
+    "journalctl": {"--rotate", "--flush", "--vacuum-size", "--vacuum-time", "--vacuum-files"},
+    "date": {"-s", "--set"},
+}
+# Programs that are read-only only in their query forms: rpm in query/verify mode, and
+# ifconfig listing interfaces (any setting after the interface name changes it)
+RPM_QUERY_MODE = re.compile(r"-[qV][A-Za-z]*|--(query|verify|querytags|version|help)")
+IFCONFIG_LIST_OPTIONS = {"-a", "-s", "-v"}
+COMMAND_SEPARATORS = {"|", "||", "&&", ";", "&", "(", ")"}
+SAFE_REDIRECT_TARGETS = {"/dev/null", "&1", "&2"}
+
+def split_command(command: str):
+    """Splits a command line into words and shell operators; raises ValueError on unbalanced quotes."""
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    return list(lexer)
+
+def normalize_command(command: str) -> str:
+    """
+    Canonical form of a command line used as the cache key: quoting and the whitespace between
+    words are normalized, while quoted arguments keep their exact content. A command that
+    can't be split is used as it is.
+    """
+    try:
+        words = split_command(command)
+    except ValueError:
+        return command.strip()
+    return " ".join(w if re.fullmatch(r"[;&|<>()]+", w) else shlex.quote(w) for w in words)
+
+def command_cache_ttl(command: str):
+    """
+    Classifies a command line. Returns its cache TTL in seconds if every part of it is
+    read-only (0 if it is read-only but not worth caching), or None if it may change the
+    remote system. Anything that can't be analysed is treated as mutating.
+    """
+    if "`" in command or "$(" in command or "<(" in command or ">(" in command:
+        return None
+    # shlex reads a line break as plain whitespace, but the shell runs each line as its own command
+    if "\n" in command or "\r" in command:
+        return None
+    try:
+        tokens = split_command(command)
+    except ValueError:
+        return None
+
+    ttl = None
+    segment = []
+    for token in tokens + [";"]:
+        if token not in COMMAND_SEPARATORS:
+            segment.append(token)
+            continue
+        if not segment:
+            continue
+        segment_ttl = segment_cache_ttl(segment)
+        if segment_ttl is None:
+            return None
+        ttl = segment_ttl if ttl is None else min(ttl, segment_ttl)
+        segment = []
+    return ttl
+
+def has_mutating_option(program, args):
+    """Whether `args` use one of the program's MUTATING_OPTIONS, also as --option=value or in a -xyz bundle."""
+    options = MUTATING_OPTIONS.get(program, set())
+    short = {option[1] for option in options if re.fullmatch(r"-[A-Za-z0-9]", option)}
+    for arg in args:
+        if arg in options or arg.startswith("--") and arg.split("=", 1)[0] in options:
+            return True
+        if re.fullmatch(r"-[A-Za-z0-9]+", arg) and short & set(arg[1:]):
+            return True
+    return False
+
+def segment_cache_ttl(words):
+    """Cache TTL of one simple command given as a word list, or None if it may write."""
+    # Output redirections other than to /dev/null or another descriptor write files
+    for i, word in enumerate(words):
+        if re.fullmatch(r"\d*(>|>>|>&|&>|>\|)", word):
+            target = words[i + 1] if i + 1 < len(words) else ""
+            if word.endswith("&") and target.isdigit() or target in SAFE_REDIRECT_TARGETS:
+                continue
+            return None
+    words = [w for w in words if not re.fullmatch(r"\d*[<>&|]+\d*", w) and w not in SAFE_REDIRECT_TARGETS]
+    while words and (words[0] == "sudo" or re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*=.*", words[0])):
+        words = words[1:]
+    if not words:
+        return None
+
+    program = words[0].rsplit("/", 1)[-1]
+    if has_mutating_option(program, words[1:]):
+        return None
+    if program in READ_ONLY_SUBCOMMANDS:
+        subcommands, ttl = READ_ONLY_SUBCOMMANDS[program]
+        subcommand = next((w for w in words[1:] if not w.startswith("-")), None)
+        return ttl if subcommand in subcommands else None
+    if program == "env" and len(words) > 1:
+        return None  # env runs another program
+    if program == "rpm" and not (len(words) > 1 and RPM_QUERY_MODE.fullmatch(words[1])):
+        return None
+    if program == "ifconfig":
+        operands = [w for w in words[1:] if w not in IFCONFIG_LIST_OPTIONS]
+        if len(operands) > 1 or any(w.startswith("-") for w in operands):
+            return None
+    return READ_ONLY_COMMANDS.get(program)
+
+class CommandResultCache:
+    """
+    Thread-safe LRU cache of read-only command results, keyed by target and normalized command.
+
+    Every target has a generation counter that is bumped whenever a mutating command starts or
+    finishes on it. A result is only stored if no mutating command touched the target while it
+    was being produced, so a flush can't be undone by a read that was already in flight.
+    """
+
+    def __init__(self, max_entries=COMMAND_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (target, command) -> (expires_at, stored_at, outcome)
+        self._generations = {}         # target -> generation
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def generation(self, target):
+        with self._lock:
+            return self._generations.get(target, 0)
+
+    def get(self, target, command):
+        with self._lock:
+            entry = self._entries.get((target, command))
+            if entry is None or entry[0] <= time.monotonic():
+                self._entries.pop((target, command), None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end((target, command))
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, target, command, outcome, ttl, generation):
+        with self._lock:
+            if self._generations.get(target, 0) != generation:
+                return
+            now = time.monotonic()
+            self._entries[(target, command)] = (now + ttl, now, outcome)
+            self._entries.move_to_end((target, command))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, target):
+        """Drops every cached result of `target`."""
+        with self._lock:
+            self._generations[target] = self._generations.get(target, 0) + 1
+            for key in [k for k in self._entries if k[0] == target]:
+                del self._entries[key]
+            self.invalidations += 1
+
+    def stats_markdown(self):
+        with self._lock:
+            return (f"Command cache: {len(self._entries)}/{self.max_entries} entries, "
+                    f"{self.hits} hits, {self.misses} misses, {self.invalidations} invalidations")
+
+
+if "command_cache" not in pn.state.cache:
+    pn.state.cache["command_cache"] = CommandResultCache()
+command_cache = pn.state.cache["command_cache"]
+
+def run_remote_command(command: str, timeout: float = 5.0, on_output=None, use_cache: bool = True, target=None) -> dict:
+    """
+    run_remote_command_shared() behind the command result cache.
+
+    Read-only commands (see command_cache_ttl) are answered from the cache while their TTL lasts;
+    the outcome then has "cached": True and "cached_age" in seconds. With use_cache=False the
+    lookup is skipped but the fresh result still refreshes the cache. Any other command flushes
+    the target's cached results before and after it runs.
+    """
+    ttl = command_cache_ttl(command) if COMMAND_CACHE_SIZE > 0 else 0
+    target = target or default_target
+    cache_target = (target["host"], target["port"], target["user"])
+    key = normalize_command(command)
+
+    if ttl is None:
+        command_cache.invalidate(cache_target)
+        try:
+            return run_remote_command_shared(command, timeout, on_output, target)
+        finally:
+            command_cache.invalidate(cache_target)
+
+    if ttl and use_cache:
+        cached = command_cache.get(cache_target, key)
+        if cached is not None:
+            stored_at, outcome = cached
+            return {**outcome, "cached": True, "cached_age": round(time.monotonic() - stored_at, 1)}
+
+    generation = command_cache.generation(cache_target)
+    outcome = run_remote_command_shared(command, timeout, on_output, target)
+    # Errors and interrupted commands are not worth repeating
+    if ttl and not outcome["timed_out"] and outcome["exit_status"] is not None:
+        command_cache.put(cache_target, key, outcome, ttl, generation)
+    return outcome
+
+# -------------------------------------------------------------------
+# Fleet Commands
+# -------------------------------------------------------------------
+# Separate from tool_executor: a fleet tool call already occupies a tool worker while it waits for its hosts
+if "fleet_executor" not in pn.state.cache:
+    pn.state.cache["fleet_executor"] = ThreadPoolExecutor(max_workers=FLEET_WORKERS, thread_name_prefix="fleet")
+fleet_executor = pn.state.cache["fleet_executor"]
+
+def run_fleet_command(command: str, selector: str = "all", timeout: float = 5.0, on_output=None, use_cache=True) -> dict:
+    """
+    Runs `command` on every target matching `selector` at once (at most FLEET_WORKERS hosts
+    in flight per process), each with its own `timeout`, so the call takes about as long as
+    the slowest host. Hosts with identical outcomes are grouped, largest group first.
+    `on_output` receives a progress line as hosts finish.
+    """
+    targets = select_targets(selector)
+    if not targets:
+        return {"command": command, "targets": 0, "groups": [],
+                "error": f"No target matches '{selector}'. Known targets: {', '.join(inventory) or 'none'}"}
+
+    futures = {
+        fleet_executor.submit(run_remote_command, command, timeout, None, use_cache, target): target["name"]
+        for target in targets
+    }
+    groups = {}
+    for done, future in enumerate(as_completed(futures), 1):
+        outcome = future.result()
+        key = (outcome["result"], outcome["exit_status"], outcome["timed_out"])
+        groups.setdefault(key, []).append(futures[future])
+        if on_output is not None:
+            on_output(f"{done}/{len(targets)} hosts finished, {len(groups)} distinct outcomes so far")
+
+    return {
+        "command": command,
+        "targets": len(targets),
+        "groups": sorted(
+            ({"hosts": sorted(hosts), "result": result, "exit_status": exit_status, "timed_out": timed_out}
+             for (result, exit_status, timed_out), hosts in groups.items()),
+            key=lambda group: (-len(group["hosts"]), group["hosts"]),
+        ),
+    }
+
+def format_fleet_result(outcome: dict) -> str:
+    """Markdown summary of a fleet run: one block per group of hosts with identical outcome."""
+    if "error" in outcome:
+        return outcome["error"]
+    blocks = []
+    for group in outcome["groups"]:
+        status_note = format_exit_status(group)
+        hosts = ", ".join(group["hosts"])
+        blocks.append(f"**{len(group['hosts'])} host(s)** ({status_note}): {hosts}\n```\n{group['result']}\n```")
+    return "\n\n".join(blocks)
+
+# -------------------------------------------------------------------
+# Remote File Tools (SFTP)
+# -------------------------------------------------------------------
+# Files are read over an SFTP channel on a pooled transport: no PTY, so no terminal noise,
+# binary content survives, and only the requested range is transferred.
+
+@contextmanager
+def sftp_session():
+    """Opens an SFTP client on one channel slot of the shared SSH pool."""
+    target = default_target
+    with ssh_pool.transport(target["host"], target["port"], target["user"], target["password"]) as transport:
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        try:
+            yield sftp
+        finally:
+            sftp.close()
+
+def file_type(mode):
+    if stat.S_ISDIR(mode):
+        return "directory"
+    if stat.S_ISLNK(mode):
+        return "symlink"
+    if stat.S_ISREG(mode):
+        return "file"
+    return "other"
+
+def describe_attributes(attributes):
+    """JSON-friendly view of an SFTPAttributes object."""
+    return {
+        "type": file_type(attributes.st_mode or 0),
+        "size": attributes.st_size,
+        "mode": stat.filemode(attributes.st_mode or 0),
+        "uid": attributes.st_uid,
+        "gid": attributes.st_gid,
+        "modified": datetime.fromtimestamp(attributes.st_mtime).isoformat() if attributes.st_mtime else None,
+    }
+
+def decode_content(data):
+    """
+    UTF-8 text is returned as-is; anything else is returned base64-encoded. A few bytes at either
+    end are not checked, since a byte range may cut a multi-byte character in half.
+    """
+    is_text = b"\0" not in data
+    try:
+        data[3:-3].decode("utf-8")
+    except UnicodeDecodeError:
+        is_text = False
+    if not is_text:
+        return "base64", base64.b64encode(data).decode("ascii")
+    return "utf-8", data.decode("utf-8", errors="replace")
+
+def read_remote_file(path, offset=0, length=None, start_line=None, end_line=None) -> dict:
+    """
+    Reads part of a remote file. Either a byte range (`offset`, negative counts from the end,
+    and `length`) or a 1-based inclusive line range (`start_line`, `end_line`); at most
+    READ_FILE_LIMIT bytes are returned in both cases and "truncated" says whether more was asked for.
+    """
+    try:
+        with sftp_session() as sftp:
+            size = sftp.stat(path).st_size or 0
+            with sftp.open(path, "rb") as remote_file:
+                if start_line is None and end_line is None:
+                    if offset < 0:
+                        offset = max(size + offset, 0)
+                    wanted = size - offset if length is None else length
+                    length = max(min(wanted, READ_FILE_LIMIT, size - offset), 0)
+                    data = b"".join(remote_file.readv([(offset, length)])) if length else b""
+                    encoding, content = decode_content(data)
+                    return {"path": path, "size": size, "offset": offset, "bytes": len(data),
+                            "truncated": wanted > length, "encoding": encoding, "content": content}
+
+                # Line ranges have to be found by reading from the start, so stop as soon as they are complete
+                start_line = max(start_line or 1, 1)
+                lines = []
+                line_number = 0  # complete lines seen so far
+                collected = 0
+                truncated = False
+                pending = b""
+                while not truncated and (end_line is None or line_number < end_line):
+                    chunk = remote_file.read(32768)
+                    parts = (pending + chunk).split(b"\n")
+                    pending = parts.pop() if chunk else b""
+                    if not chunk and parts == [b""]:
+                        break
+                    for part in parts:
+                        line_number += 1
+                        if line_number < start_line:
+                            continue
+                        if end_line is not None and line_number > end_line:
+                            break
+                        line = part + b"\n" if chunk else part
+                        if collected + len(line) > READ_FILE_LIMIT:
+                            lines.append(line[:READ_FILE_LIMIT - collected])
+                            truncated = True
+                            break
+                        lines.append(line)
+                        collected += len(line)
+                    if not chunk:
+                        break
+                    if line_number + 1 < start_line:
+                        pending = b""  # still before the range: only newlines matter
+                    elif len(pending) > READ_FILE_LIMIT - collected:
+                        lines.append(pending[:READ_FILE_LIMIT - collected])
+                        line_number += 1
+                        truncated = True
+                encoding, content = decode_content(b"".join(lines))
+                return {"path": path, "size": size, "start_line": start_line,
+                        "end_line": start_line + len(lines) - 1, "truncated": truncated,
+                        "encoding": encoding, "content": content}
+    except Exception as e:
+        return {"path": path, "error": f"Could not read file: {e}"}
+
+def list_remote_dir(path) -> dict:
+    """Lists a remote directory (name, type, size, mode, mtime), sorted by name and capped at LIST_DIR_LIMIT."""
+    try:
+        with sftp_session() as sftp:
+            entries = sorted(sftp.listdir_attr(path), key=lambda a: a.filename)
+    except Exception as e:
+        return {"path": path, "error": f"Could not list directory: {e}"}
+    return {
+        "path": path,
+        "count": len(entries),
+        "truncated": len(entries) > LIST_DIR_LIMIT,
+        "entries": [{"name": a.filename, **describe_attributes(a)} for a in entries[:LIST_DIR_LIMIT]],
+    }
+
+def stat_remote_path(path) -> dict:
+    """Type, size, permissions, owner and modification time of a remote path (symlinks are not followed)."""
     try:
-        client = get_ssh_client()
-        channel = client.invoke_shell(width=120, height=80)
-        
-        channel.send(command + "\n")
-        
-        output_chunks = []
-        start_time = time.time()
-
-        while True:
-            while channel.recv_ready():
-                chunk = channel.recv(2048).decode("utf-8", errors="ignore")
-                output_chunks.append(chunk)
-
-            # Check if the command ended naturally
-            if channel.exit_status_ready():
-                break
-
-            # If we have a positive timeout and exceeded it, send Ctrl-C
-            if timeout > 0 and (time.time() - start_time) > timeout:
-                channel.send("\x03")  # Ctrl-C
-                time.sleep(0.5)
-                break
-
-            time.sleep(0.1)
-
-        # Grab any remaining data
-        time.sleep(0.2)
-        while channel.recv_ready():
-            chunk = channel.recv(2048).decode("utf-8", errors="ignore")
-            output_chunks.append(chunk)
-
-        channel.close()
-        result = "".join(output_chunks).strip()
-        return result if result else "Command produced no output."
+        with sftp_session() as sftp:
+            attributes = sftp.lstat(path)
+            info = {"path": path, **describe_attributes(attributes)}
+            if stat.S_ISLNK(attributes.st_mode or 0):
+                info["target"] = sftp.readlink(path)
+            return info
     except Exception as e:
-        global persistent_ssh_client
-        persistent_ssh_client = None
-        return f"Error executing command: {e}"
+        return {"path": path, "error": f"Could not stat path: {e}"}
+
+FILE_TOOLS = {
+    "read_file": read_remote_file,
+    "list_dir": list_remote_dir,
+    "stat": stat_remote_path,
+}
+
+# -------------------------------------------------------------------
+# Background Jobs
+# -------------------------------------------------------------------
+# A job runs detached on the target (setsid + nohup) with its output spooled to JOB_DIR/<id>.log,
+# so it survives the exec channel and never blocks a chat turn. Status, output and cancellation
+# all go through the files next to the log: <id>.pid (also the process group) and <id>.exit.
+# Jobs belong to the session that started them: `background_jobs` (job id -> {"command",
+# "started"}) is this session's entry of a process-wide registry keyed by the stored session
+# id, so a resumed session finds its jobs again. It is bound once the session id is known.
+
+def job_paths(job_id):
+    base = f"{JOB_DIR}/{job_id}"
+    return {"log": base + ".log", "pid": base + ".pid", "exit": base + ".exit"}
+
+def check_job_id(job_id):
+    """Job ids end up in shell commands, so only ids handed out by start_job() are accepted."""
+    if job_id not in background_jobs:
+        raise ValueError(f"Unknown job id {job_id!r}; call job_status without a job id to list this session's jobs")
+
+def start_job(command: str) -> dict:
+    """Starts `command` as a background job on the default target and returns its id immediately."""
+    job_id = uuid.uuid4().hex[:8]
+    paths = job_paths(job_id)
+    # The subshell keeps an `exit` in the command from skipping the exit status file
+    script = f"(\n{command}\n)\necho $? > {shlex.quote(paths['exit'])}"
+    launcher = (
+        f"mkdir -p {shlex.quote(JOB_DIR)} || exit 1; "
+        f"setsid nohup bash -c {shlex.quote(script)} > {shlex.quote(paths['log'])} 2>&1 < /dev/null & "
+        f"echo $! > {shlex.quote(paths['pid'])}"
+    )
+    outcome = run_remote_command(launcher)
+    if outcome["exit_status"] != 0:
+        return {"error": f"Could not start job: {outcome['result']}"}
+    background_jobs[job_id] = {"command": command, "started": time.time()}
+    return {"job_id": job_id, "status": "running", "log": paths["log"]}
+
+def job_status(job_id: str = None) -> dict:
+    """
+    Status of one job ("running", "exited", "cancelled" or "lost" if the process is gone without
+    an exit status) with its exit status and output size; without `job_id`, the status of all jobs.
+    """
+    if job_id is None:
+        return {"jobs": [job_status(known_id) for known_id in list(background_jobs)]}
+    try:
+        check_job_id(job_id)
+    except ValueError as e:
+        return {"error": str(e)}
+    paths = {name: shlex.quote(path) for name, path in job_paths(job_id).items()}
+    probe = (
+        f"if [ -s {paths['exit']} ]; then echo \"exited $(cat {paths['exit']})\"; "
+        f"elif kill -0 $(cat {paths['pid']}) 2>/dev/null; then echo running; else echo lost; fi; "
+        f"stat -c %s {paths['log']} 2>/dev/null || echo 0"
+    )
+    # Not through the result cache: the probe is read-only but must always be fresh
+    outcome = run_remote_command_shared(probe)
+    words = outcome["result"].split()
+    if outcome["exit_status"] != 0 or len(words) < 2:
+        return {"job_id": job_id, "error": f"Could not query job: {outcome['result']}"}
+    job = background_jobs[job_id]
+    status = {
+        "job_id": job_id,
+        "command": job["command"],
+        "status": words[0],
+        "exit_status": None,
+        "output_bytes": int(words[-1]) if words[-1].isdigit() else None,
+        "elapsed": round(time.time() - job["started"], 1),
+    }
+    if words[0] == "exited":
+        status["status"], status["exit_status"] = ("exited", int(words[1])) if words[1].isdigit() else ("cancelled", None)
+    return status
+
+def job_output(job_id: str, offset: int = 0, length: int = None) -> dict:
+    """
+    Output of a job from byte `offset` on (at most READ_FILE_LIMIT bytes), plus its status.
+    Pass the returned "next_offset" on the next call to read only what was added since.
+    """
+    try:
+        check_job_id(job_id)
+    except ValueError as e:
+        return {"error": str(e)}
+    chunk = read_remote_file(job_paths(job_id)["log"], offset, length)
+    if "error" in chunk:
+        return {"job_id": job_id, "error": chunk["error"]}
+    status = job_status(job_id)
+    return {
+        **status,
+        "offset": chunk["offset"],
+        "next_offset": chunk["offset"] + chunk["bytes"],
+        "encoding": chunk["encoding"],
+        "content": compact_output(chunk["content"]) if chunk["encoding"] == "utf-8" else chunk["content"],
+    }
+
+def cancel_job(job_id: str) -> dict:
+    """Sends SIGTERM to the job's process group, then SIGKILL if it is still alive after 2 seconds."""
+    try:
+        check_job_id(job_id)
+    except ValueError as e:
+        return {"error": str(e)}
+    paths = {name: shlex.quote(path) for name, path in job_paths(job_id).items()}
+    script = (
+        f"[ -s {paths['exit']} ] && exit 0; pgid=$(cat {paths['pid']}); "
+        f"kill -TERM -- -$pgid 2>/dev/null; sleep 2; kill -KILL -- -$pgid 2>/dev/null; "
+        f"[ -s {paths['exit']} ] || echo cancelled > {paths['exit']}"
+    )
+    run_remote_command(script, timeout=10)
+    return job_status(job_id)
+
+JOB_TOOLS = {
+    "start_job": start_job,
+    "job_status": job_status,
+    "job_output": job_output,
+    "cancel_job": cancel_job,
+}
+
+# -------------------------------------------------------------------
+# Session Store (shared/llm_common.py)
+# -------------------------------------------------------------------
+session_store = setup_session_store(SESSION_DIR, SESSION_FSYNC_INTERVAL)
 
 # -------------------------------------------------------------------
 # HELPERS
 # -------------------------------------------------------------------
 def notify_error(error_message):
     print(error_message)
-    chat_history.object += f"> **⚠️ Error:** {error_message}\n\n"
+    chat_log.append(f"> **⚠️ Error:** {error_message}")
+
+def start_live_output(title):
+    """
+    Adds panes showing a running command's output below the chat and the manual terminal.
+    Returns (update, finish): update(text) refreshes both panes and may be called from a
+    worker thread; finish() removes the panes once the final result has been rendered.
+    """
+    chat_pane = pn.pane.Markdown(f"{title}", sizing_mode="stretch_width")
+    manual_pane = pn.pane.Markdown(f"{title}", sizing_mode="stretch_width")
+    live_chat_output.append(chat_pane)
+    live_manual_output.append(manual_pane)
+
+    def update(text):
+        chat_pane.object = manual_pane.object = f"{title}\n```\n{text}\n```"
+
+    def finish():
+        live_chat_output.remove(chat_pane)
+        live_manual_output.remove(manual_pane)
+
+    return update, finish
+
+# -------------------------------------------------------------------
+# Context Budget
+# -------------------------------------------------------------------
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Returns the tiktoken encoding for `model`, or None to use the character-based estimate."""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:  # e.g. the encoding file could not be downloaded
+        print(f"Token counting falls back to an estimate: {e}")
+        return None
+
+def count_tokens(text, model):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+def message_tokens(message, model):
+    """Approximate prompt tokens used by one API message, including tool calls."""
+    tokens = 4 + count_tokens(message.get("content") or "", model)
+    for tool_call in message.get("tool_calls") or []:
+        tokens += count_tokens(tool_call["function"]["name"] + tool_call["function"]["arguments"], model)
+    return tokens
+
+def context_budget(model):
+    if CONTEXT_BUDGET_TOKENS:
+        return CONTEXT_BUDGET_TOKENS
+    matches = [prefix for prefix in MODEL_CONTEXT_BUDGETS if model.startswith(prefix)]
+    return MODEL_CONTEXT_BUDGETS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_BUDGET
+
+def tool_output_limit(model, pending=(), calls=1):
+    """
+    Tokens the output of each of `calls` tool results may use, so that the prompt (api_conversation
+    plus the `pending` messages about to join it) stays within the budget with all of them added:
+    an equal share of what is left, at most TOOL_OUTPUT_TOKEN_LIMIT and at least MIN_TOOL_OUTPUT_TOKENS.
+    """
+    used = sum(message_tokens(message, model) for message in [*api_conversation, *pending])
+    per_message = TOOL_MESSAGE_OVERHEAD + message_tokens({"role": "tool", "content": ""}, model)
+    remaining = context_budget(model) - used - calls * per_message
+    return max(min(TOOL_OUTPUT_TOKEN_LIMIT, remaining // calls), MIN_TOOL_OUTPUT_TOKENS)
+
+def truncate_to_tokens(text, limit, model):
+    """Keeps the head and tail of `text` within `limit` tokens, marking what was elided."""
+    encoding = get_encoding(model)
+    if encoding is None:
+        if len(text) <= limit * 4:
+            return text
+        half = max(limit - ELISION_MARKER_TOKENS, 0) * 2
+        return f"{text[:half]}\n... [about {(len(text) - 2 * half) // 4} tokens elided] ...\n{text[-half:]}"
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= limit:
+        return text
+    half = max(limit - ELISION_MARKER_TOKENS, 0) // 2
+    return (f"{encoding.decode(tokens[:half])}\n... [{len(tokens) - 2 * half} tokens elided] ...\n"
+            f"{encoding.decode(tokens[-half:])}")
+
+async def summarize_messages(previous_summary, messages, model):
+    """Asks the model to fold `messages` into the rolling summary; falls back to a plain note on errors."""
+    transcript = []
+    for message in messages:
+        content = truncate_to_tokens(message.get("content") or "", 300, model)
+        for tool_call in message.get("tool_calls") or []:
+            content += f"\n[requested {tool_call['function']['name']}: {tool_call['function']['arguments']}]"
+        transcript.append(f"{message['role']}: {content}")
+    prompt = (
+        f"Previous summary:\n{previous_summary or '(none)'}\n\n"
+        "Conversation to add:\n" + "\n\n".join(transcript)
+    )
+    try:
+        response, _ = await cached_create(
+            async_client,
+            model=model,
+            messages=[
+                {"role": "system", "content": (
+                    "You maintain a running summary of a shell session between a user and an assistant. "
+                    "Merge the new conversation into the previous summary. Keep facts about the remote system, "
+                    "commands that were run and their key results, and open questions. Be concise."
+                )},
+                {"role": "user", "content": prompt},
+            ],
+            temperature=0,
+        )
+        summary = response.choices[0].message.content or ""
+    except OpenAIError as e:
+        print(f"Summarization failed: {e}")
+        summary = f"{previous_summary}\n({len(messages)} earlier messages were dropped to save context.)".strip()
+    return truncate_to_tokens(summary, SUMMARY_TOKEN_LIMIT, model)
+
+async def fit_conversation_to_budget(model):
+    """
+    Keeps the prompt for `model` within its token budget by folding the oldest turns of
+    api_conversation into a rolling summary message. The system prompt and the current turn
+    (everything from the latest user message on) are always kept verbatim.
+    """
+    budget = context_budget(model)
+    tokens = [message_tokens(message, model) for message in api_conversation]
+    if sum(tokens) <= budget:
+        return
+
+    has_summary = (len(api_conversation) > 1 and api_conversation[1]["role"] == "system"
+                   and api_conversation[1]["content"].startswith(SUMMARY_PREFIX))
+    head = 2 if has_summary else 1
+    turn_starts = [i for i in range(head, len(api_conversation)) if api_conversation[i]["role"] == "user"]
+    if len(turn_starts) < 2:
+        return
+
+    # Fold the fewest old turns that bring the rest (plus room for the summary) within budget
+    fold_end = turn_starts[-1]
+    for start in turn_starts[1:]:
+        if tokens[0] + SUMMARY_TOKEN_LIMIT + sum(tokens[start:]) <= budget:
+            fold_end = start
+            break
+
+    previous_summary = api_conversation[1]["content"][len(SUMMARY_PREFIX):] if has_summary else ""
+    folded = api_conversation[head:fold_end]
+    summary = await summarize_messages(previous_summary, folded, model)
+    api_conversation[1:fold_end] = [{"role": "system", "content": SUMMARY_PREFIX + summary}]
+    # The stored summary counts messages over the whole session; everything after it is kept
+    persist({"kind": "summary", "text": summary, "upto": session["count"] - (len(api_conversation) - 2)})
+    chat_log.append(f"> **🗂️ Context:** folded {len(folded)} earlier messages into a summary "
+                    f"to stay within the {budget}-token budget.")
 
 # -------------------------------------------------------------------
 # Chat + Function-Calling
 # -------------------------------------------------------------------
-chat_history = pn.pane.Markdown("### Chat History\n\n", width=600, height=400)
-chat_history_container = pn.Row(chat_history, sizing_mode='stretch_both', css_classes=['scrollable'])
+chat_log = MessageLog("### Chat History", window=CHAT_WINDOW, width=600, height=400, scroll=True, auto_scroll_limit=100)
+chat_history_container = pn.Row(chat_log, sizing_mode='stretch_both', css_classes=['scrollable'])
+live_chat_output = pn.Column(sizing_mode='stretch_width')
 user_input = pn.widgets.TextInput(placeholder='Type your message here...', sizing_mode='stretch_width')
 send_button = pn.widgets.Button(name='Send', button_type='primary')
 clear_button = pn.widgets.Button(name='Clear', button_type='warning')
@@ -144,19 +1294,95 @@ api_conversation = [
     {"role": "system", "content": (
         "You are a helpful assistant that can execute shell commands remotely via SSH. "
         "When needed, use the 'run_command' tool with the required parameters to run a command. "
+        "To look at files, use 'read_file' (with a line or byte range for large files), 'list_dir' and 'stat' "
+        "instead of cat or ls. "
+        "Start long-running commands with 'start_job' and check on them with 'job_status' and 'job_output'. "
+        "Independent commands can be requested together in one turn; they run in parallel. "
         "For example, if a user asks 'What does ls -la / show?', generate a tool call with the command: ls -la /."
     )}
 ]
 
+# One agent loop at a time per session, since it appends to api_conversation
+agent_lock = asyncio.Lock()
+# The stored session this browser session writes to; "count" numbers its messages
+session = {"id": current_session_id(), "count": 0}
+background_jobs = pn.state.cache.setdefault("background_jobs", {}).setdefault(session["id"], {})
+
+def persist(record):
+    if session_store is not None:
+        session_store.append(session["id"], record)
+
+def remember(message):
+    """Appends a message to api_conversation and to the session store."""
+    api_conversation.append(message)
+    persist({"kind": "message", "n": session["count"], "message": message})
+    session["count"] += 1
+
+def answer_open_tool_calls(messages):
+    """
+    Gives every assistant tool call a tool message, as the API requires: a session stored
+    before its tool results (e.g. the process died while a command ran) gets an error result
+    for each missing answer, and tool messages without a matching call are dropped.
+    """
+    repaired, open_calls = [], {}
+
+    def close_open_calls():
+        for tool_call in open_calls.values():
+            repaired.append({
+                "role": "tool",
+                "name": tool_call["function"]["name"],
+                "content": json.dumps({"error": "No result: the session was interrupted before the tool finished."}),
+                "tool_call_id": tool_call["id"],
+            })
+        open_calls.clear()
+
+    for message in messages:
+        if message["role"] == "tool":
+            if open_calls.pop(message.get("tool_call_id"), None) is not None:
+                repaired.append(message)
+            continue
+        close_open_calls()
+        repaired.append(message)
+        if message["role"] == "assistant":
+            open_calls.update((tool_call["id"], tool_call) for tool_call in message.get("tool_calls") or [])
+    close_open_calls()
+    return repaired
+
+def resume_session():
+    """
+    Loads a stored chat: the rolling summary and the messages after it, i.e. what the next
+    prompt needs, however long the session has become. Tool output is not shown again.
+    """
+    if session_store is None:
+        return
+    stored_summary, records = session_store.tail(session["id"])
+    if stored_summary is not None:
+        api_conversation.append({"role": "system", "content": SUMMARY_PREFIX + stored_summary["text"]})
+    if not records:
+        return
+    session["count"] = records[-1]["n"] + 1
+    if records[0]["n"]:
+        chat_log.append(f"*Resumed session: {records[0]['n']} earlier messages are folded into the summary.*")
+    for message in answer_open_tool_calls([record["message"] for record in records]):
+        api_conversation.append(message)
+        if message["role"] == "user":
+            chat_log.append(f"> **🧑 You:** {message['content']}")
+        elif message["role"] == "assistant" and message.get("content"):
+            chat_log.append(f"> **🤖 Assistant:** {message['content']}")
+
 # Debug pane
 conversation_debug = pn.pane.Markdown("### Conversation Debug\n\n", width=600, height=200)
 
 def update_conversation_debug():
+    # Serializing the whole conversation is only worth it while someone is looking at it
+    if not debug_toggle.value:
+        return
     conversation_debug.object = "### Conversation Debug\n\n```\n" + json.dumps(api_conversation, indent=2) + "\n```"
 
 debug_toggle = pn.widgets.Toggle(name="Show Debug", value=False)
 def toggle_debug(event):
     debug_pane.visible = debug_toggle.value
+    update_conversation_debug()
 
 debug_toggle.param.watch(toggle_debug, 'value')
 debug_pane = pn.Column(conversation_debug)
@@ -170,7 +1396,8 @@ run_command_tool = {
         "description": (
             "Execute a shell command remotely via SSH on the target container. "
             "By default, the command will be forcibly stopped after 5 seconds. "
-            "If you set timeout=0, the command can run indefinitely."
+            "If you set timeout=0, the command can run indefinitely and blocks until it ends; "
+            "use start_job for long-running commands instead."
         ),
         "parameters": {
             "type": "object",
@@ -185,6 +1412,13 @@ run_command_tool = {
                         "Optional. Number of seconds before forcibly sending Ctrl-C. "
                         "Set to 0 for indefinite run, defaults to 5 if omitted."
                     )
+                },
+                "fresh": {
+                    "type": "boolean",
+                    "description": (
+                        "Optional. Results of read-only commands may be served from a short-lived cache "
+                        "(marked with \"cached\": true). Set to true to force a new run."
+                    )
                 }
             },
             "required": ["command"],
@@ -193,7 +1427,174 @@ run_command_tool = {
     }
 }
 
-def call_chat_api(messages, tools=None):
+path_parameter = {"type": "string", "description": "Absolute path on the remote machine."}
+file_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "read_file",
+            "description": (
+                "Read a remote file over SFTP without a terminal. Prefer this over 'cat' for inspecting files. "
+                "Give either a byte range (offset, length; a negative offset counts from the end) or a "
+                "1-based inclusive line range (start_line, end_line). Without a range the file is read from "
+                f"the start. At most {READ_FILE_LIMIT} bytes are returned per call; 'truncated' tells whether "
+                "there is more. Binary content is returned base64-encoded."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "path": path_parameter,
+                    "offset": {"type": "integer", "description": "Optional. Byte offset to start reading at."},
+                    "length": {"type": "integer", "description": "Optional. Number of bytes to read."},
+                    "start_line": {"type": "integer", "description": "Optional. First line to return (1-based)."},
+                    "end_line": {"type": "integer", "description": "Optional. Last line to return (inclusive)."}
+                },
+                "required": ["path"],
+                "additionalProperties": False
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "list_dir",
+            "description": "List a remote directory over SFTP with type, size, permissions and modification time.",
+            "parameters": {
+                "type": "object",
+                "properties": {"path": path_parameter},
+                "required": ["path"],
+                "additionalProperties": False
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "stat",
+            "description": "Get type, size, permissions, owner and modification time of a remote path over SFTP.",
+            "parameters": {
+                "type": "object",
+                "properties": {"path": path_parameter},
+                "required": ["path"],
+                "additionalProperties": False
+            }
+        }
+    },
+]
+fleet_groups = sorted({group for target in inventory.values() for group in target["groups"]})
+run_command_fleet_tool = {
+    "type": "function",
+    "function": {
+        "name": "run_command_fleet",
+        "description": (
+            "Execute the same shell command on several SSH targets at once and get the outputs grouped: "
+            "hosts with identical output and exit status are reported together. "
+            f"Targets: {', '.join(list(inventory)[:50])}{' ...' if len(inventory) > 50 else ''}. "
+            f"Groups: {', '.join(fleet_groups) or 'none'}."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "command": {
+                    "type": "string",
+                    "description": "The bash command to execute on each selected machine."
+                },
+                "targets": {
+                    "type": "string",
+                    "description": (
+                        "Which machines to run on: 'all', or a comma-separated list of target names, "
+                        "group names and patterns like 'web*'."
+                    )
+                },
+                "timeout": {
+                    "type": "number",
+                    "description": "Optional. Seconds before Ctrl-C is sent, per host; defaults to 5."
+                }
+            },
+            "required": ["command", "targets"],
+            "additionalProperties": False
+        }
+    }
+}
+
+job_id_parameter = {"type": "string", "description": "Job id returned by start_job."}
+job_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "start_job",
+            "description": (
+                "Start a long-running shell command (build, scan, log capture, ...) in the background on the "
+                "target and return a job id at once. Its output is spooled on the target; follow it with "
+                "job_output and job_status while continuing the conversation."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {"command": {"type": "string", "description": "The bash command to run."}},
+                "required": ["command"],
+                "additionalProperties": False
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "job_status",
+            "description": "Status (running/exited/cancelled/lost), exit status and output size of a job; all jobs if job_id is omitted.",
+            "parameters": {
+                "type": "object",
+                "properties": {"job_id": job_id_parameter},
+                "additionalProperties": False
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "job_output",
+            "description": (
+                "Read a job's output from a byte offset. Pass the returned next_offset on the next call "
+                "to get only new output."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "job_id": job_id_parameter,
+                    "offset": {"type": "integer", "description": "Optional. Byte offset to read from; negative counts from the end."},
+                    "length": {"type": "integer", "description": "Optional. Maximum number of bytes to return."}
+                },
+                "required": ["job_id"],
+                "additionalProperties": False
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "cancel_job",
+            "description": "Stop a background job (SIGTERM to its process group, SIGKILL after 2 seconds).",
+            "parameters": {
+                "type": "object",
+                "properties": {"job_id": job_id_parameter},
+                "required": ["job_id"],
+                "additionalProperties": False
+            }
+        }
+    },
+]
+
+agent_tools = [run_command_tool] + file_tools + job_tools
+if len(inventory) > 1:
+    agent_tools.append(run_command_fleet_tool)
+
+async def call_chat_api(messages, tools=None):
+    """
+    Requests the next assistant message and returns it as a dict in API message format.
+    With STREAM_REPLIES the completion is streamed: content tokens are rendered in the chat
+    pane as they arrive and tool-call arguments are reassembled from their deltas.
+    The streamed preview is removed again; the caller renders the final message.
+    Requests allowed by LLM_CACHE are answered from the completion cache when possible.
+    """
     try:
         payload = {
             "model": model_select.value,  # the selected model
@@ -201,108 +1602,257 @@ def call_chat_api(messages, tools=None):
         }
         if tools:
             payload["tools"] = tools
-        return client.chat.completions.create(**payload)
+
+        if not STREAM_REPLIES:
+            response, _ = await cached_create(async_client, **payload)
+        else:
+            with StreamPreview(chat_log, "> **🤖 Assistant:**") as preview:
+                response, _ = await cached_create(async_client, on_content=preview, **payload)
+        message = response.choices[0].message
+        return {
+            "role": message.role,
+            "content": message.content or "",
+            "tool_calls": [
+                {
+                    "id": tool_call.id,
+                    "type": tool_call.type,
+                    "function": {
+                        "name": tool_call.function.name,
+                        "arguments": tool_call.function.arguments
+                    }
+                }
+                for tool_call in message.tool_calls or []
+            ]
+        }
     except OpenAIError as e:
         notify_error(f"OpenAI API error: {e}")
         return None
 
-def send_message(event=None):
+def parse_tool_arguments(tool_call):
+    """Returns (arguments, error) for a tool call; arguments is None if they are not a JSON object."""
+    try:
+        arguments = json.loads(tool_call["function"]["arguments"])
+    except Exception as e:
+        return None, f"Invalid tool arguments: {e}"
+    if not isinstance(arguments, dict):
+        return None, "Invalid tool arguments: expected a JSON object"
+    return arguments, None
+
+def run_tool_call(tool_call, on_output=None, limit=TOOL_OUTPUT_TOKEN_LIMIT):
+    """
+    Executes one tool call requested by the assistant and returns the matching tool message,
+    whose output is cut to `limit` tokens.
+    Runs on the shared tool executor; apart from the `on_output` progress callback it must
+    not touch any Panel objects. It always returns a tool message, so that every tool call
+    of the assistant gets its answer; a tool that fails reports the error with outcome None.
+    """
+    tool_name = tool_call["function"]["name"]
+    arguments, error = parse_tool_arguments(tool_call)
+    try:
+        content, outcome = tool_call_content(tool_name, arguments, error, on_output, limit)
+    except Exception as e:
+        content, outcome = json.dumps({"error": f"{tool_name} failed: {e}"}), None
+    if outcome is not None:
+        # Outcomes without one large output field (a long directory listing) are cut as a whole
+        content = truncate_to_tokens(content, limit + TOOL_MESSAGE_OVERHEAD, model_select.value)
+
+    tool_message = {
+        "role": "tool",
+        "name": tool_name,
+        "content": content,
+        "tool_call_id": tool_call["id"]
+    }
+    return tool_message, arguments, outcome
+
+def tool_call_content(tool_name, arguments, error, on_output, limit):
+    """
+    Runs a tool and returns the content of its tool message, with the output cut to `limit`
+    tokens, and the outcome for the UI.
+    """
+    outcome = None
+    if error:
+        content = json.dumps({"error": error})
+    elif tool_name == "run_command":
+        outcome = run_remote_command(arguments.get("command", ""), arguments.get("timeout", 5.0), on_output,
+                                     use_cache=not arguments.get("fresh", False))
+        # The UI shows the full output; the model gets a head/tail window of it
+        result = truncate_to_tokens(outcome["result"], limit, model_select.value)
+        content = json.dumps({"command": arguments.get("command"), **outcome, "result": result})
+    elif tool_name == "run_command_fleet":
+        outcome = run_fleet_command(arguments.get("command", ""), arguments.get("targets", "all"),
+                                    arguments.get("timeout", 5.0), on_output)
+        # Share the output budget between the groups
+        group_limit = max(limit // max(len(outcome["groups"]), 1), MIN_TOOL_OUTPUT_TOKENS)
+        groups = [{**group, "result": truncate_to_tokens(group["result"], group_limit, model_select.value)}
+                  for group in outcome["groups"]]
+        content = json.dumps({**outcome, "groups": groups})
+    elif tool_name in FILE_TOOLS or tool_name in JOB_TOOLS:
+        try:
+            outcome = {**FILE_TOOLS, **JOB_TOOLS}[tool_name](**arguments)
+        except TypeError as e:
+            outcome = {"error": f"Invalid tool arguments: {e}"}
+        result = outcome.get("content")
+        if isinstance(result, str):
+            result = truncate_to_tokens(result, limit, model_select.value)
+        content = json.dumps({**outcome, "content": result} if "content" in outcome else outcome)
+    else:
+        content = json.dumps({"error": f"Unknown tool: {tool_name}"})
+    return content, outcome
+
+def describe_tool_call(tool_name, arguments):
+    """Short Markdown label of a tool call for the chat and terminal panes."""
+    if tool_name == "run_command":
+        return f"`{arguments.get('command')}`"
+    if tool_name == "run_command_fleet":
+        return f"`{arguments.get('command')}` on `{arguments.get('targets', 'all')}`"
+    if tool_name == "read_file" and ("start_line" in arguments or "end_line" in arguments):
+        return f"`{tool_name} {arguments.get('path')}` lines {arguments.get('start_line', 1)}-{arguments.get('end_line', 'end')}"
+    if tool_name == "read_file" and ("offset" in arguments or "length" in arguments):
+        return f"`{tool_name} {arguments.get('path')}` bytes from {arguments.get('offset', 0)} ({arguments.get('length', 'all')})"
+    if tool_name == "start_job":
+        return f"`{arguments.get('command')}`"
+    if tool_name in JOB_TOOLS:
+        return f"`{tool_name} {arguments['job_id']}`" if arguments.get("job_id") else f"`{tool_name}`"
+    return f"`{tool_name} {arguments.get('path')}`"
+
+def format_tool_result(tool_name, outcome):
+    """Plain-text view of a file or job tool's outcome for the chat and terminal panes."""
+    if "error" in outcome:
+        return outcome["error"]
+    if tool_name in ("read_file", "job_output"):
+        if outcome["encoding"] == "base64":
+            return f"[{outcome.get('bytes', 'some')} bytes of binary content]"
+        return outcome["content"]
+    if tool_name == "list_dir":
+        lines = [f"{e['mode']} {e['size']:>10} {e['modified'] or '':19} {e['name']}" for e in outcome["entries"]]
+        if outcome["truncated"]:
+            lines.append(f"... {outcome['count'] - len(outcome['entries'])} more entries")
+        return "\n".join(lines) or "(empty directory)"
+    return json.dumps(outcome, indent=2)
+
+def show_tool_result(tool_name, arguments, outcome):
+    if outcome is None:
+        return
+    if tool_name in FILE_TOOLS or tool_name in JOB_TOOLS:
+        label = describe_tool_call(tool_name, arguments)
+        result = format_tool_result(tool_name, outcome)
+        icon = "📄" if tool_name in FILE_TOOLS else "⚙️"
+        chat_log.append(f"> **{icon} {tool_name} (LLM):** {label}\n\n```\n{result}\n```")
+        manual_log.append(f"> **LLM {tool_name}:** {label}\n```\n{result}\n```")
+        return
+    if tool_name == "run_command_fleet":
+        label = describe_tool_call(tool_name, arguments)
+        result = format_fleet_result(outcome)
+        chat_log.append(f"> **🛠️ Ran on {outcome['targets']} host(s) (LLM):** {label}\n\n{result}")
+        manual_log.append(f"> **LLM executed on {outcome['targets']} host(s):** {label}\n\n{result}")
+        return
+    command_to_run = arguments.get("command")
+    result = outcome["result"]
+    status_note = format_exit_status(outcome)
+    chat_log.append(f"> **🛠️ Ran Command (LLM):** `{command_to_run}` ({status_note})\n\n```\n{result}\n```")
+    manual_log.append(f"> **LLM executed:** `{command_to_run}` ({status_note})\n```\n{result}\n```")
+
+async def run_agent_loop():
+    """
+    Calls the model until it stops requesting tools. Every tool call of a step is executed
+    concurrently and all results are returned to the model in the next request.
+    Once AGENT_MAX_STEPS or AGENT_MAX_SECONDS is reached, the model is called one last
+    time without tools so that it has to answer with what it has.
+    """
+    started = time.monotonic()
+    for step in range(AGENT_MAX_STEPS):
+        out_of_budget = step == AGENT_MAX_STEPS - 1 or time.monotonic() - started > AGENT_MAX_SECONDS
+        await fit_conversation_to_budget(model_select.value)
+        assistant_message = await call_chat_api(api_conversation, tools=None if out_of_budget else agent_tools)
+        if not assistant_message:
+            return
+
+        assistant_content = assistant_message["content"]
+        tool_calls = assistant_message["tool_calls"]
+
+        if not tool_calls:
+            remember({"role": "assistant", "content": assistant_content})
+            chat_log.append(f"> **🤖 Assistant:** {assistant_content}")
+            update_conversation_debug()
+            return
+
+        # The assistant message with its tool_calls joins the conversation (and the session
+        # store) together with the results below, so it is never stored without its answers
+        if assistant_content:
+            chat_log.append(f"> **🤖 Assistant:** {assistant_content}")
+        live_outputs = []
+        for tool_call in tool_calls:
+            arguments, error = parse_tool_arguments(tool_call)
+            tool_name = tool_call["function"]["name"]
+            if error:
+                chat_log.append(f"> **🤖 Assistant (Error):** {error}")
+                live_outputs.append((None, None))
+            elif tool_name not in ("run_command", "run_command_fleet"):
+                chat_log.append(f"> **🤖 Assistant requested {tool_name}:** {describe_tool_call(tool_name, arguments)}")
+                live_outputs.append((None, None))
+            else:
+                label = describe_tool_call(tool_name, arguments)
+                chat_log.append(f"> **🤖 Assistant requested command execution:** {label}")
+                live_outputs.append(start_live_output(f"**⏳ Running (LLM):** {label}"))
+
+        # The step's results share what is left of the budget, since the conversation is
+        # only fitted to it again before the next model call and never shrinks the current turn
+        limit = tool_output_limit(model_select.value, [assistant_message], len(tool_calls))
+        # Execute the tool calls in parallel with live output, then report them in the order they were requested
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(
+            loop.run_in_executor(tool_executor, run_tool_call, tool_call, update, limit)
+            for tool_call, (update, _) in zip(tool_calls, live_outputs)
+        ))
+        remember(assistant_message)
+        for (tool_message, arguments, outcome), (_, finish_live) in zip(results, live_outputs):
+            if finish_live:
+                finish_live()
+            if outcome is None and arguments is not None:
+                chat_log.append(f"> **⚠️ Error:** {json.loads(tool_message['content'])['error']}")
+            show_tool_result(tool_message["name"], arguments, outcome)
+            remember(tool_message)
+        update_conversation_debug()
+
+async def send_message(event=None):
     user_msg = user_input.value.strip()
     if not user_msg:
         pn.state.notifications.warning("Please enter a message.")
         return
+    if agent_lock.locked():
+        pn.state.notifications.warning("The assistant is still working on the previous message.")
+        return
 
     # Append user message
-    chat_history.object += f"> **🧑 You:** {user_msg}\n\n"
-    api_conversation.append({"role": "user", "content": user_msg})
+    chat_log.append(f"> **🧑 You:** {user_msg}")
+    remember({"role": "user", "content": user_msg})
     update_conversation_debug()
     user_input.value = ""
 
-    # Call the API
-    response = call_chat_api(api_conversation, tools=[run_command_tool])
-    if not response:
-        return
-
-    assistant_message = response.choices[0].message
-    assistant_content = assistant_message.content if assistant_message.content else ""
-    
-    if assistant_message.tool_calls:
-        tool_call = assistant_message.tool_calls[0]
-        tool_name = tool_call.function.name
-        try:
-            arguments = json.loads(tool_call.function.arguments)
-        except Exception as e:
-            arguments = {}
-            chat_history.object += f"> **🤖 Assistant (Error):** Invalid tool arguments: {e}\n\n"
-        
-        if tool_name == "run_command":
-            command_to_run = arguments.get("command")
-            chat_history.object += f"> **🤖 Assistant requested command execution:** `{command_to_run}`\n\n"
-            
-            tool_id = tool_call.id
-            tool_type = tool_call.type
-
-            # Add assistant message with tool_calls
-            assistant_dict = {
-                "role": assistant_message.role,
-                "content": assistant_content,
-                "tool_calls": [
-                    {
-                        "id": tool_id,
-                        "type": tool_type,
-                        "function": {
-                            "name": tool_call.function.name,
-                            "arguments": tool_call.function.arguments
-                        }
-                    }
-                ]
-            }
-            api_conversation.append(assistant_dict)
-            
-            # Execute the remote command
-            result = run_remote_command_shared(command_to_run)
-            chat_history.object += f"> **🛠️ Ran Command (LLM):** `{command_to_run}`\n\n"
-            chat_history.object += f"```\n{result}\n```\n\n"
-            manual_output.object += f"> **LLM executed:** `{command_to_run}`\n```\n{result}\n```\n\n"
-
-            # Create tool response message
-            tool_response_message = {
-                "role": "tool",
-                "name": "run_command",
-                "content": json.dumps({"command": command_to_run, "result": result}),
-                "tool_call_id": tool_id
-            }
-            api_conversation.append(tool_response_message)
-            update_conversation_debug()
-            
-            # Follow-up call
-            response2 = call_chat_api(api_conversation, tools=[run_command_tool])
-            if response2:
-                new_assistant_message = response2.choices[0].message
-                new_assistant_content = new_assistant_message.content or ""
-                api_conversation.append({"role": "assistant", "content": new_assistant_content})
-                chat_history.object += f"> **🤖 Assistant:** {new_assistant_content}\n\n"
-                update_conversation_debug()
-        else:
-            api_conversation.append({"role": "assistant", "content": assistant_content})
-            chat_history.object += f"> **🤖 Assistant:** {assistant_content}\n\n"
-            update_conversation_debug()
-    else:
-        api_conversation.append({"role": "assistant", "content": assistant_content})
-        chat_history.object += f"> **🤖 Assistant:** {assistant_content}\n\n"
-        update_conversation_debug()
+    started = time.perf_counter()
+    async with agent_lock:
+        await run_agent_loop()
+    metrics["agent_turn"].observe(time.perf_counter() - started)
 
 def clear_chat(event):
     global api_conversation
     api_conversation = [
         {"role": "system", "content": (
             "You are a helpful assistant that can execute shell commands remotely via SSH. "
-            "When needed, use the 'run_command' tool with the required parameters to run a command."
+            "When needed, use the 'run_command' tool with the required parameters to run a command. "
+            "To look at files, use 'read_file' (with a line or byte range for large files), 'list_dir' and 'stat' "
+            "instead of cat or ls. "
+            "Start long-running commands with 'start_job' and check on them with 'job_status' and 'job_output'. "
+            "Independent commands can be requested together in one turn; they run in parallel."
         )}
     ]
-    chat_history.object = "### Chat History\n\n"
+    persist({"kind": "clear"})
+    session["count"] = 0
+    chat_log.clear()
     update_conversation_debug()
 
+resume_session()
+
 send_button.on_click(send_message)
 user_input.param.watch(send_message, "enter_pressed")
 clear_button.on_click(clear_chat)
@@ -312,28 +1862,41 @@ clear_button.on_click(clear_chat)
 # -------------------------------------------------------------------
 command_input_manual = pn.widgets.TextInput(placeholder="Type bash command here...", width=600)
 execute_button_manual = pn.widgets.Button(name='Execute', button_type='primary')
-manual_output = pn.pane.Markdown("", min_width=600, min_height=400, sizing_mode="stretch_both", styles={'overflow-y': 'auto'})
+manual_log = MessageLog(window=CHAT_WINDOW, min_width=600, min_height=400, sizing_mode="stretch_both", scroll=True, auto_scroll_limit=100)
+live_manual_output = pn.Column(sizing_mode="stretch_width")
 
-def run_manual_command(event):
+async def run_manual_command(event):
     cmd = command_input_manual.value.strip()
     if not cmd:
-        manual_output.object = "Please enter a command."
+        pn.state.notifications.warning("Please enter a command.")
         return
 
-    result = run_remote_command_shared(cmd)
-    api_conversation.append({"role": "user", 
-                             "content": f"User executed a command in the shell:\n{cmd}\nOutput:\n{result}"})
+    update_live, finish_live = start_live_output(f"**⏳ Running (Manual):** `{cmd}`")
+    try:
+        outcome = await asyncio.get_running_loop().run_in_executor(
+            tool_executor, partial(run_remote_command, cmd, on_output=update_live, use_cache=False)
+        )
+    finally:
+        finish_live()
+    result = outcome["result"]
+    status_note = format_exit_status(outcome)
+    manual_log.append(f"> **Manual executed:** `{cmd}` ({status_note})\n```\n{result}\n```")
+    chat_log.append(f"> **Manual executed:** `{cmd}` ({status_note})\n```\n{result}\n```")
+
+    # Wait for a running agent loop so the note doesn't land between its tool calls and their results
+    async with agent_lock:
+        llm_result = truncate_to_tokens(result, tool_output_limit(model_select.value), model_select.value)
+        remember({"role": "user",
+                  "content": f"User executed a command in the shell ({status_note}):\n{cmd}\nOutput:\n{llm_result}"})
     update_conversation_debug()
-    
-    manual_output.object += f"> **Manual executed:** `{cmd}`\n```\n{result}\n```\n\n"
-    chat_history.object += f"> **Manual executed:** `{cmd}`\n```\n{result}\n```\n\n"
 
 execute_button_manual.on_click(run_manual_command)
 manual_ssh_layout = pn.Column(
     "# Manual SSH Terminal",
     command_input_manual,
     execute_button_manual,
-    manual_output,
+    live_manual_output,
+    manual_log,
     sizing_mode="stretch_width"
 )
 
@@ -352,6 +1915,7 @@ app_layout = pn.Column(
         pn.Column(
             "# Chat with LLM (with command tool)",
             chat_history_container,
+            live_chat_output,
             pn.Row(user_input, send_button, clear_button, sizing_mode='stretch_width'),
         ),
         pn.Spacer(width=30),
@@ -365,6 +1929,8 @@ app_layout = pn.Column(
     )
 )
 
+app_layout = stats_tab(app_layout, "Chat", [command_cache.stats_markdown])
+
 app_layout.servable()
 
 if __name__ == '__main__':
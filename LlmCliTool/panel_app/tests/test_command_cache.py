@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("OPENAI_API_KEY", "not-needed")
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ.setdefault("SESSION_DIR", tempfile.mkdtemp())
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app  # noqa: E402
+
+
+def test_each_line_is_a_command_of_its_own():
+    assert app.command_cache_ttl("ls /tmp") == 30
+    assert app.command_cache_ttl("ls /tmp\nrm -rf /tmp/x") is None
+    assert app.command_cache_ttl("ls /tmp\r\nrm -rf /tmp/x") is None
+    assert app.command_cache_ttl("ls /tmp\nls /var") is None
+
+
+def test_mutating_forms_of_read_only_programs():
+    for command in ["rpm -e openssl", "rpm -ivh x.rpm", "rpm -U x.rpm", "rpm --erase openssl", "rpm",
+                    "ifconfig eth0 down", "ifconfig eth0 192.168.0.2", "ifconfig eth0 -promisc",
+                    "tree -o /etc/passwd", "tree -ao /etc/passwd", "dpkg --unpack x.deb", "ss -K dst 10.0.0.1",
+                    "less -o /etc/passwd /var/log/syslog", "git diff --output=/etc/passwd", "ip netns exec x sh"]:
+        assert app.command_cache_ttl(command) is None, command
+    for command in ["rpm -qa", "rpm -qi openssl", "rpm --query openssl", "rpm -Va",
+                    "ifconfig", "ifconfig -a", "ifconfig eth0", "tree /etc", "git diff", "ss -tlnp"]:
+        assert app.command_cache_ttl(command) is not None, command
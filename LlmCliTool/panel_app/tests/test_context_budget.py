@@ -0,0 +1,33 @@
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("OPENAI_API_KEY", "not-needed")
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ.setdefault("SESSION_DIR", tempfile.mkdtemp())
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app  # noqa: E402
+
+
+def read_call(call_id):
+    return {"id": call_id, "type": "function", "function": {"name": "read_file", "arguments": '{"path": "/log"}'}}
+
+
+def test_step_results_share_the_remaining_budget(monkeypatch):
+    model = app.model_select.value
+    monkeypatch.setattr(app, "CONTEXT_BUDGET_TOKENS", 3000)
+    monkeypatch.setitem(app.FILE_TOOLS, "read_file", lambda path: {"path": path, "content": "line\n" * 20000})
+    assistant_message = {"role": "assistant", "content": None, "tool_calls": [read_call(c) for c in "abc"]}
+
+    limit = app.tool_output_limit(model, [assistant_message], 3)
+    assert limit < app.TOOL_OUTPUT_TOKEN_LIMIT
+    results = [app.run_tool_call(call, limit=limit)[0] for call in assistant_message["tool_calls"]]
+    assert all("elided" in result["content"] for result in results)
+    prompt = [*app.api_conversation, assistant_message, *results]
+    assert sum(app.message_tokens(message, model) for message in prompt) <= 3000
+
+
+def test_limit_has_a_floor_when_the_budget_is_used_up(monkeypatch):
+    monkeypatch.setattr(app, "CONTEXT_BUDGET_TOKENS", 10)
+    assert app.tool_output_limit(app.model_select.value, calls=4) == app.MIN_TOOL_OUTPUT_TOKENS
@@ -0,0 +1,57 @@
+import json
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("OPENAI_API_KEY", "not-needed")
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ["SESSION_DIR"] = tempfile.mkdtemp()
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app  # noqa: E402
+
+
+def tool_call(call_id):
+    return {"id": call_id, "type": "function", "function": {"name": "run_command", "arguments": '{"command": "ls"}'}}
+
+
+def store(session_id, messages):
+    for n, message in enumerate(messages):
+        app.session_store.append(session_id, {"kind": "message", "n": n, "message": message})
+
+
+def resume(session_id):
+    del app.api_conversation[1:]
+    app.session.update(id=session_id, count=0)
+    app.resume_session()
+    return app.api_conversation[1:]
+
+
+def test_resume_answers_trailing_tool_calls():
+    store("trailing-calls", [
+        {"role": "user", "content": "list files"},
+        {"role": "assistant", "content": None, "tool_calls": [tool_call("a"), tool_call("b")]},
+        {"role": "tool", "name": "run_command", "content": "{}", "tool_call_id": "a"},
+    ])
+    messages = resume("trailing-calls")
+    assert [m["role"] for m in messages] == ["user", "assistant", "tool", "tool"]
+    assert [m["tool_call_id"] for m in messages[2:]] == ["a", "b"]
+    assert "interrupted" in json.loads(messages[3]["content"])["error"]
+    assert app.session["count"] == 3
+
+
+def test_resume_drops_orphan_tool_messages():
+    messages = app.answer_open_tool_calls([
+        {"role": "user", "content": "hi"},
+        {"role": "tool", "name": "run_command", "content": "{}", "tool_call_id": "x"},
+        {"role": "assistant", "content": "hello"},
+    ])
+    assert [m["role"] for m in messages] == ["user", "assistant"]
+
+
+def test_invalid_arguments_still_answer_the_call():
+    call = {"id": "c", "type": "function", "function": {"name": "run_command", "arguments": "[1, 2]"}}
+    tool_message, arguments, outcome = app.run_tool_call(call)
+    assert tool_message["tool_call_id"] == "c"
+    assert arguments is None and outcome is None
+    assert "JSON object" in json.loads(tool_message["content"])["error"]
@@ -1,9 +1,17 @@
 import panel as pn
+import asyncio
 import random
-import time
-from openai import OpenAI, OpenAIError
+import numpy as np
+import re
+import sys
+from openai import AsyncOpenAI, OpenAIError
 import os
 
+# Helpers shared with the other apps: ../shared in the repository, /opt/shared (on PYTHONPATH) in the image
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+from llm_common import (cached_create, setup_completion_cache, setup_metrics, setup_request_scheduler,  # noqa: E402
+                        stats_tab)
+
 pn.extension(notifications=True)  # Enable notifications
 
 # Add custom CSS for scrolling
@@ -19,24 +27,61 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 if not OPENAI_API_KEY:
     raise ValueError("Please set the OPENAI_API_KEY environment variable.")
 
-# Initialize OpenAI client
-try:
-    client = OpenAI(api_key=OPENAI_API_KEY)  # Ensure API key is passed
-except OpenAIError as e:
-    pn.state.notifications.error(f"OpenAI initialization failed: {e}")
-    raise
+# Initialize the OpenAI client once per server process; every session shares it and its connection pool.
+# It is async so a running experiment doesn't block the server for other sessions.
+if "openai_client" not in pn.state.cache:
+    try:
+        pn.state.cache["openai_client"] = AsyncOpenAI(api_key=OPENAI_API_KEY)  # Ensure API key is passed
+    except OpenAIError as e:
+        pn.state.notifications.error(f"OpenAI initialization failed: {e}")
+        raise
+client = pn.state.cache["openai_client"]
+
+# Answer requests of one experiment that may be in flight at once
+SAMPLE_CONCURRENCY = int(os.getenv('SAMPLE_CONCURRENCY', '8'))
+
+# Model used for generating, answering and aggregating (e.g. the name served by a local OpenAI-compatible server)
+MODEL = os.getenv('OPENAI_MODEL', 'gpt-4')
+
+# Local consensus: confidence-weighted vote share that counts as decisive, the samples needed before
+# trusting it, and how many more samples each round draws when stopping early
+CONSENSUS_THRESHOLD = float(os.getenv('CONSENSUS_THRESHOLD', '0.8'))
+MIN_CONSENSUS_SAMPLES = int(os.getenv('MIN_CONSENSUS_SAMPLES', '3'))
+CONSENSUS_ROUND_SIZE = int(os.getenv('CONSENSUS_ROUND_SIZE', '3'))
+
+# -------------------------------------------------------------------
+# Metrics, Completion Cache and Request Scheduler (shared/llm_common.py)
+# -------------------------------------------------------------------
+setup_metrics()
+setup_completion_cache()
+request_scheduler = setup_request_scheduler(client)
+
+async def create_completion(**params):
+    """
+    Calls the chat completions API through the request scheduler and records the request in the metrics.
+    Requests allowed by LLM_CACHE are answered from the completion cache when possible.
+    """
+    response, _ = await cached_create(request_scheduler, **params)
+    return response
 
 # Panel widgets
 # Remove problem_selector since problems are now generated automatically
 temperature_slider = pn.widgets.FloatSlider(name='Max Temperature', start=0.0, end=1.0, step=0.1, value=0.5)
 iterations_spinner = pn.widgets.IntInput(name='Iterations', value=3, step=1)
+early_stop_checkbox = pn.widgets.Checkbox(name='Stop sampling once the answers reach consensus', value=True)
+batch_checkbox = pn.widgets.Checkbox(name='Batch samples that share a temperature (0.1 steps) into one request', value=True)
 run_button = pn.widgets.Button(name='Run Experiment', button_type='primary')
+cancel_button = pn.widgets.Button(name='Cancel', button_type='warning', disabled=True)
+progress_bar = pn.indicators.Progress(name='Samples', value=0, max=1, width=600, visible=False)
 
 # Panel output area
 output_area = pn.pane.Markdown("### Experiment Output\n", width=600)
 
+# The experiment running in this session, so the cancel button can stop it
+current_run = {"task": None}
+
 # New helper function to generate a hard math problem using an LLM
-def generate_hard_problem(temperature=0.7):
+async def generate_hard_problem(temperature=0.7):
     prompt = ("You are an expert math problem creator. "
               "Generate a challenging math problem that is difficult enough to occasionally cause errors when solved. "
               "Be creative and ensure the problem has multiple steps or twists. "
@@ -47,8 +92,8 @@ def generate_hard_problem(temperature=0.7):
     messages = [system_prompt, user_prompt]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
+        response = await create_completion(
+            model=MODEL,
             messages=messages,
             temperature=temperature
         )
@@ -57,8 +102,15 @@ def generate_hard_problem(temperature=0.7):
     except Exception as e:
         return f"Error generating problem: {e}"
 
-# Helper function to call the LLM for a single answer
-def ask_llm(problem_prompt, temperature):
+# Samples whose request failed carry this prefix instead of an answer
+FAILED_ANSWER = "Error in answer"
+
+def is_failed_answer(answer):
+    return answer.startswith(FAILED_ANSWER)
+
+# Helper function to call the LLM for `n` answers sampled at the same temperature
+async def sample_answers(problem_prompt, temperature, n=1):
+    """Returns the answers and the usage of the request (None if it failed)."""
     system_prompt = {"role": "system", "content": "You are a helpful math expert. Answer the question and then provide your confidence in your answer on a scale from 0 to 1 on a separate line."}
     user_prompt = {"role": "user", "content": problem_prompt}
     conversation = [user_prompt]
@@ -67,20 +119,137 @@ def ask_llm(problem_prompt, temperature):
     messages_llm1 = [system_prompt] + conversation
 
     try:
-        # Make the OpenAI API call for the answer
-        response = client.chat.completions.create(
-            model="gpt-4",
+        # Make the OpenAI API call; n > 1 returns several independent samples in one request
+        params = {"n": n} if n > 1 else {}
+        response = await create_completion(
+            model=MODEL,
             messages=messages_llm1,
-            temperature=temperature
+            temperature=temperature,
+            **params
         )
         # Parse the response
-        answer_text = response.choices[0].message.content.strip()
-        return answer_text
+        answers = [choice.message.content.strip() for choice in response.choices]
+        missing = [f"{FAILED_ANSWER}: only {len(answers)} of {n} samples returned"] * (n - len(answers))
+        return answers + missing, response.usage
     except Exception as e:
-        return f"Error in answer: {e}"
+        return [f"{FAILED_ANSWER}: {e}"] * n, None
+
+async def ask_llm(problem_prompt, temperature, n=1):
+    answers, _ = await sample_answers(problem_prompt, temperature, n)
+    return answers
+
+# Helpers to score the answers locally
+NUMBER = r"-?\d+(?:,\d{3})*(?:\.\d+)?(?:/\d+)?"
+# A confidence on a 0-1 scale or as a percentage; a trailing full stop is punctuation, not a decimal point
+CONFIDENCE = re.compile(r"(?<![\d.])(\d+(?:\.\d+)?\s*%|0(?:\.\d+)?|1(?:\.0+)?|\.\d+)(?!\d|\.\d)")
+# LaTeX that wraps a number without changing it
+LATEX_FRACTION = re.compile(r"\\[dt]?frac\s*\{\s*(-?\d+)\s*\}\s*\{\s*(\d+)\s*\}")
+LATEX_WRAPPER = re.compile(r"\\(?:boxed|text|mathrm|textbf)\s*\{([^{}]*)\}")
+LATEX_NOISE = re.compile(r"\\[,!;: ]|\\[()\[\]]|[$*]")
+# Characters next to a number that make it part of a larger expression
+OPERATORS = "^*+-/×·{}\\"
+
+def parse_confidence(answer):
+    """The self-assessed confidence in [0, 1] from the end of an answer, or None."""
+    lines = [line for line in answer.strip().splitlines() if line.strip()]
+    for distance, line in enumerate(reversed(lines[-3:])):
+        numbers = CONFIDENCE.findall(line)
+        # Only trust a bare number if it is on the last line
+        if numbers and ("confidence" in line.lower() or distance == 0):
+            number = numbers[-1]
+            if number.endswith("%"):
+                percent = float(number.rstrip("% "))
+                return percent / 100 if percent <= 100 else None
+            return float(number)
+    return None
+
+def answer_expression(text):
+    """What a line states as the result: LaTeX markup removed, fractions as a/b, only what follows the last '='."""
+    text = LATEX_FRACTION.sub(r"\1/\2", text)
+    text = LATEX_WRAPPER.sub(r"\1", text)
+    text = LATEX_NOISE.sub(" ", text)
+    return re.split(r"=|\\approx|≈", text)[-1].strip()
+
+def normalize_number(number):
+    """"1,000", "1000.0" and "2000/2" all become "1000"."""
+    number = number.replace(",", "")
+    numerator, _, denominator = number.partition("/")
+    try:
+        value = float(numerator) / float(denominator or 1)
+    except ZeroDivisionError:
+        return number
+    return f"{value:.6g}"
+
+def parse_final_answer(answer):
+    """
+    The final answer in a comparable form: the number stated as the answer (normalized, so
+    "1,000", "1000.0", "2000/2" and "$\frac{2000}{2}$" agree), else the last number of the last
+    line before the confidence line, else a stated answer without digits in lower case. None if
+    nothing can be found, or if the answer is an expression rather than a plain number
+    (2^{10}, \sqrt{2}), since a number picked out of it would be a guess.
+    """
+    lines = [line for line in answer.strip().splitlines() if line.strip() and "confidence" not in line.lower()]
+    body = "\n".join(lines)
+    stated = re.findall(r"\b(?:final answer|answer)\b\s*(?:is|:|=)?\s*([^\n]+)", body, re.IGNORECASE)
+    if stated:
+        # Up to the end of the sentence ("... is 5, because 2 + 3 = 5")
+        sentence = re.split(r"[.;:,](?:\s|$)|\s+(?:because|since|as|which|so)\b", stated[-1])[0]
+        expression = answer_expression(sentence)
+        match = re.fullmatch(rf"({NUMBER})\s*(?:[A-Za-z%°][A-Za-z%° ]*)?[.!]?", expression)
+        if match:
+            return normalize_number(match.group(1))
+        if re.search(r"\d", expression):
+            return None
+        return expression.strip(" .").lower() or None
+
+    expression = answer_expression(lines[-1]) if lines else ""
+    numbers = list(re.finditer(NUMBER, expression))
+    if not numbers:
+        return None
+    last = numbers[-1]
+    before = expression[:last.start()].rstrip()[-1:]
+    after = expression[last.end():].lstrip()[:1]
+    if before and before in OPERATORS or after and after in OPERATORS:
+        return None
+    return normalize_number(last.group())
+
+def local_consensus(answers):
+    """
+    Scores the answers without an LLM call. Each parsed final answer gets a confidence-weighted
+    vote (answers without a stated confidence count with the mean confidence of the others);
+    unparseable answers only count towards the total. Failed samples are left out entirely.
+    Returns the leading answer with its weighted "support", plain "agreement" share and mean
+    confidence, the number of "samples" that voted and "failed", and whether it is "decisive".
+    """
+    failed = sum(is_failed_answer(answer) for answer in answers)
+    answers = [answer for answer in answers if not is_failed_answer(answer)]
+    finals = [parse_final_answer(answer) for answer in answers]
+    confidences = np.array([parse_confidence(answer) for answer in answers], dtype=float)
+    known = ~np.isnan(confidences)
+    default = confidences[known].mean() if known.any() else 0.5
+    weights = np.clip(np.where(known, confidences, default), 0.0, 1.0)
+
+    parsed = np.array([final is not None for final in finals])
+    if not parsed.any() or weights.sum() == 0:
+        return {"answer": None, "support": 0.0, "agreement": 0.0, "mean_confidence": float(default),
+                "samples": len(answers), "failed": failed, "decisive": False}
+    labels, inverse = np.unique(np.array([final or "" for final in finals])[parsed], return_inverse=True)
+    votes = np.bincount(inverse, weights=weights[parsed], minlength=len(labels))
+    counts = np.bincount(inverse, minlength=len(labels))
+    best = int(np.argmax(votes))
+    support = float(votes[best] / weights.sum())
+    return {
+        "answer": str(labels[best]),
+        "support": support,
+        "agreement": float(counts[best] / len(answers)),
+        "mean_confidence": float(weights[parsed][inverse == best].mean()),
+        "samples": len(answers),
+        "failed": failed,
+        "decisive": len(answers) >= MIN_CONSENSUS_SAMPLES and support >= CONSENSUS_THRESHOLD,
+    }
 
 # Helper function to aggregate responses with another LLM call
-def aggregate_answers(problem_prompt, responses, temperature):
+async def aggregate_answers(problem_prompt, responses, temperature):
     # Create a prompt for aggregation that includes all the responses
     aggregation_prompt = f"You are an expert judge. Here is a math problem: '{problem_prompt}'. " \
                          f"The following are different answers along with the LLM's self-assessed confidence on a scale from 0 to 1:\n\n"
@@ -93,8 +262,8 @@ def aggregate_answers(problem_prompt, responses, temperature):
     messages_llm2 = [system_prompt, user_prompt]
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
+        response = await create_completion(
+            model=MODEL,
             messages=messages_llm2,
             temperature=temperature
         )
@@ -104,57 +273,144 @@ def aggregate_answers(problem_prompt, responses, temperature):
         return f"Error in aggregation: {e}"
 
 # Experiment runner callback
-def run_experiment(event):
-    output_lines = []
-    
-    # Generate a hard problem using an LLM call
-    generation_temperature = 0.7  # You can adjust this for more or less creative problems
-    generated_problem = generate_hard_problem(temperature=generation_temperature)
-    output_lines.append(f"**Generated Problem:** {generated_problem}")
-    
+def consensus_line(consensus, used, iterations):
+    failed = f", {consensus['failed']} failed" if consensus["failed"] else ""
+    if consensus["answer"] is None:
+        return f"No parseable final answer yet ({used} of {iterations} samples{failed})."
+    return (
+        f"**Answer:** {consensus['answer']} with {consensus['support']:.0%} of the confidence-weighted vote "
+        f"({consensus['agreement']:.0%} of {consensus['samples']} answers agree, mean confidence "
+        f"{consensus['mean_confidence']:.2f}); {used} of {iterations} samples used{failed}."
+    )
+
+async def run_experiment(event):
+    current_run["task"] = asyncio.current_task()
+    run_button.disabled = True
+    cancel_button.disabled = False
+
     max_temperature = temperature_slider.value
     iterations = iterations_spinner.value
-    output_lines.append(f"**Max Temperature for Answering:** {max_temperature}")
-    output_lines.append(f"**Iterations:** {iterations}\n")
-
-    responses = []
-    # Run the experiment for a number of iterations
-    for i in range(iterations):
-        # Vary temperature randomly between 0 and max_temperature
-        random_temperature = random.uniform(0, max_temperature)
-        output_lines.append(f"**Iteration {i+1}:** Using temperature {random_temperature:.2f}")
-        
-        # Optionally modify the problem prompt slightly to simulate seed variance
-        random_suffix = f"(iteration {i} - {random.random():.4f})"
-        modified_prompt = generated_problem + " " + random_suffix
-
-        answer = ask_llm(modified_prompt, random_temperature)
-        responses.append(answer)
-        output_lines.append(f"**Answer:** {answer}\n")
-        # Optional pause to avoid rate-limiting
-        time.sleep(1)
-
-    # Aggregate answers with the second LLM using a fixed low temperature for determinism
-    aggregation_temperature = 0
-    aggregated_result = aggregate_answers(generated_problem, responses, aggregation_temperature)
-    output_lines.append("### Aggregated Answer and Confidence")
-    output_lines.append(aggregated_result)
-
-    # Update the output area
-    output_area.object = "\n\n".join(output_lines)
+    header = [f"**Max Temperature for Answering:** {max_temperature}", f"**Iterations:** {iterations}\n"]
+    temperatures = []
+    responses = [None] * iterations
+    footer = []
+    pending = set()
+
+    def render(status):
+        # Results are redrawn in iteration order as samples arrive, so the pane is usable at any point
+        lines = list(header)
+        for i, answer in enumerate(responses):
+            if answer is not None:
+                lines.append(f"**Iteration {i+1}:** Using temperature {temperatures[i]:.2f}")
+                lines.append(f"**Answer:** {answer}\n")
+        done = [answer for answer in responses if answer is not None]
+        if done:
+            lines.append("### Local Consensus")
+            lines.append(consensus_line(local_consensus(done), len(done), iterations))
+        lines.extend(footer)
+        lines.append(f"*{status}*")
+        output_area.object = "\n\n".join(lines)
+        progress_bar.value = len(done)
+
+    progress_bar.max = max(iterations, 1)
+    progress_bar.value = 0
+    progress_bar.visible = True
+    try:
+        render("Generating a problem...")
+
+        # Generate a hard problem using an LLM call
+        generation_temperature = 0.7  # You can adjust this for more or less creative problems
+        generated_problem = await generate_hard_problem(temperature=generation_temperature)
+        header.insert(0, f"**Generated Problem:** {generated_problem}")
+
+        # Vary temperature randomly between 0 and max_temperature. When batching, temperatures are
+        # rounded to the slider's 0.1 steps and the samples of one temperature share a request (n=k)
+        temperatures = [random.uniform(0, max_temperature) for _ in range(iterations)]
+        if batch_checkbox.value:
+            temperatures = [round(temperature, 1) for temperature in temperatures]
+
+        # Issue the requests of a round concurrently, at most SAMPLE_CONCURRENCY at a time
+        semaphore = asyncio.Semaphore(SAMPLE_CONCURRENCY)
+
+        async def sample(indices):
+            # Optionally modify the problem prompt slightly to simulate seed variance
+            random_suffix = f"(iteration {indices[0]} - {random.random():.4f})"
+            modified_prompt = generated_problem + " " + random_suffix
+            async with semaphore:
+                return indices, await ask_llm(modified_prompt, temperatures[indices[0]], n=len(indices))
+
+        # Without early stopping the whole budget is one round; with it, sampling continues in small
+        # rounds only until the answers so far reach a decisive consensus
+        if early_stop_checkbox.value:
+            first_round = max(MIN_CONSENSUS_SAMPLES, 1)
+            round_ends = list(range(first_round, iterations, max(CONSENSUS_ROUND_SIZE, 1))) + [iterations]
+        else:
+            round_ends = [iterations]
+
+        used = 0
+        render(f"Sampling 0 of {iterations}...")
+        for round_end in round_ends:
+            batches = {}  # batch key -> iteration indices
+            for i in range(used, round_end):
+                batches.setdefault(temperatures[i] if batch_checkbox.value else i, []).append(i)
+            pending = {asyncio.ensure_future(sample(indices)) for indices in batches.values()}
+            for next_done in asyncio.as_completed(pending):
+                indices, answers = await next_done
+                for i, answer in zip(indices, answers):
+                    responses[i] = answer
+                render(f"Sampling {sum(answer is not None for answer in responses)} of {iterations}...")
+            used = round_end
+            consensus = local_consensus(responses[:used])
+            if consensus["decisive"]:
+                break
+        responses = responses[:used]
+
+        footer.append("### Aggregated Answer and Confidence")
+        if consensus["decisive"]:
+            # A decisive local consensus makes the aggregation call unnecessary
+            footer.append(f"Skipped: the local consensus is decisive (threshold {CONSENSUS_THRESHOLD:.0%}).")
+            render("Done.")
+        else:
+            render("Aggregating...")
+            # Aggregate answers with the second LLM using a fixed low temperature for determinism
+            aggregation_temperature = 0
+            aggregated_result = await aggregate_answers(generated_problem, responses, aggregation_temperature)
+            footer.append(aggregated_result)
+            render("Done.")
+    except asyncio.CancelledError:
+        # Keep whatever has arrived; outstanding requests are cancelled below
+        if footer == ["### Aggregated Answer and Confidence"]:
+            footer.append("Cancelled before the aggregated answer arrived.")
+        render("Cancelled. The results above are partial.")
+    finally:
+        for task in pending:
+            task.cancel()
+        current_run["task"] = None
+        run_button.disabled = False
+        cancel_button.disabled = True
+
+def cancel_experiment(event):
+    if current_run["task"] is not None:
+        current_run["task"].cancel()
 
 # Link the run button to the experiment function
 run_button.on_click(run_experiment)
+cancel_button.on_click(cancel_experiment)
 
 # Layout the Panel app
 app_layout = pn.Column(
     pn.pane.Markdown("## LLM Consistency Experiment With Generated Challenges", styles={'font-size': '20px'}),
     temperature_slider,
     iterations_spinner,
-    run_button,
+    early_stop_checkbox,
+    batch_checkbox,
+    pn.Row(run_button, cancel_button),
+    progress_bar,
     output_area
 )
 
+app_layout = stats_tab(app_layout, "Experiment", [request_scheduler.stats_markdown])
+
 # Serve the app
 app_layout.servable()
 
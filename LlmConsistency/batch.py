@@ -0,0 +1,262 @@
+"""
+Headless batch runner for the consistency experiment.
+
+Runs problems x temperatures x iterations with the same generate_hard_problem, sample_answers
+and aggregate_answers as the Panel app and writes one row per sample to CSV or Parquet.
+Progress is checkpointed to a JSONL file, so an interrupted run picks up where it stopped
+when started again with the same arguments.
+
+    python batch.py --config experiment.json --out results.parquet
+    python batch.py --config experiment.json --out results.csv --base-url http://localhost:8000/v1 --model llama3
+
+The config is a JSON object; every key is optional (defaults in DEFAULT_CONFIG):
+
+    {"problems": 10, "temperatures": [0.0, 0.5, 1.0], "iterations": 5,
+     "generation_temperature": 0.7, "aggregate": true, "batch": true}
+
+"problems" is the number of problems to generate or a list of problem statements. With
+"batch", each problem and temperature gets one request with n=iterations; samples a server
+returns fewer of (many local servers ignore n) are requested one by one. Without it (or with
+--no-batch) every sample is a request of its own. A problem and temperature is only
+checkpointed once all its samples are in, so failed requests are retried on the next run. With "aggregate", the
+aggregated answer per problem is written to <out>_aggregates.csv/.parquet as well; the
+aggregator is only asked when the local consensus of the samples is not decisive.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+
+DEFAULT_CONFIG = {
+    "problems": 5,
+    "temperatures": [0.0, 0.5, 1.0],
+    "iterations": 5,
+    "generation_temperature": 0.7,
+    "aggregate": True,
+    "batch": True,
+}
+
+SAMPLE_COLUMNS = [
+    "problem_id", "problem", "temperature", "iteration", "answer", "parsed_answer", "confidence", "error",
+    "request_latency_s", "request_samples", "request_prompt_tokens", "request_completion_tokens",
+]
+AGGREGATE_COLUMNS = [
+    "problem_id", "problem", "samples", "consensus_answer", "consensus_support", "consensus_agreement",
+    "aggregated_by", "aggregated_answer", "confidence", "latency_s",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the LLM consistency experiment without the UI.")
+    parser.add_argument("--config", help="JSON experiment config (see module docstring)")
+    parser.add_argument("--out", required=True, help="Result file, .csv or .parquet")
+    parser.add_argument("--checkpoint", help="Progress file (default: <out>.checkpoint.jsonl)")
+    parser.add_argument("--base-url", help="OpenAI-compatible endpoint, e.g. a local stand-in server")
+    parser.add_argument("--api-key", help="API key (default: OPENAI_API_KEY; a dummy key with --base-url)")
+    parser.add_argument("--model", help="Model name (default: OPENAI_MODEL or gpt-4)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at once")
+    parser.add_argument("--no-batch", action="store_true", help="One request per sample instead of n=iterations")
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    """The app reads its settings from the environment when imported, so set them up first."""
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "not-needed")
+    if args.api_key:
+        os.environ["OPENAI_API_KEY"] = args.api_key
+    if args.model:
+        os.environ["OPENAI_MODEL"] = args.model
+    os.environ["SAMPLE_CONCURRENCY"] = str(args.concurrency)
+    # Don't compete with a running app for the metrics port
+    os.environ.setdefault("METRICS_PORT", "0")
+
+
+class Checkpoint:
+    """
+    Append-only JSONL log of finished work: generated problems, sample batches and aggregations.
+    Each record is written as soon as its request completes, so a crash loses at most the
+    requests that were in flight.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.problems = {}    # problem_id -> text
+        self.samples = {}     # (problem_id, temperature) -> [rows]
+        self.aggregates = {}  # problem_id -> row
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # a line cut short by the interruption
+                    self._apply(record)
+        self._file = open(path, "a")
+
+    def _apply(self, record):
+        if record["kind"] == "problem":
+            self.problems[record["problem_id"]] = record["problem"]
+        elif record["kind"] == "samples":
+            self.samples[(record["problem_id"], record["temperature"])] = record["rows"]
+        elif record["kind"] == "aggregate":
+            self.aggregates[record["problem_id"]] = record["row"]
+
+    def write(self, record):
+        self._apply(record)
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+async def run_batch(app, config, checkpoint):
+    problems = config["problems"]
+    problem_count = len(problems) if isinstance(problems, list) else int(problems)
+    semaphore = asyncio.Semaphore(int(os.environ["SAMPLE_CONCURRENCY"]))
+    done = 0
+
+    async def get_problem(problem_id):
+        if problem_id in checkpoint.problems:
+            return checkpoint.problems[problem_id]
+        if isinstance(problems, list):
+            problem = problems[problem_id]
+        else:
+            async with semaphore:
+                problem = await app.generate_hard_problem(temperature=config["generation_temperature"])
+            if problem.startswith("Error generating problem"):
+                raise RuntimeError(problem)
+        checkpoint.write({"kind": "problem", "problem_id": problem_id, "problem": problem})
+        return problem
+
+    async def request_samples(problem, temperature, n):
+        """One request for `n` samples: its answers, usage (None if it failed) and latency."""
+        async with semaphore:
+            started = time.perf_counter()
+            answers, usage = await app.sample_answers(problem, temperature, n=n)
+            return answers, usage, time.perf_counter() - started
+
+    async def run_samples(problem_id, problem, temperature):
+        nonlocal done
+        if (problem_id, temperature) in checkpoint.samples:
+            return
+        iterations = config["iterations"]
+        requests = []
+        if config["batch"]:
+            answers, usage, latency = await request_samples(problem, temperature, iterations)
+            if usage is not None:
+                # A server that ignores n returns fewer choices; the rest is requested one by one below
+                requests.append(([answer for answer in answers if not app.is_failed_answer(answer)], usage, latency))
+            else:
+                requests.append((answers, usage, latency))
+        missing = iterations - sum(len(answers) for answers, _, _ in requests)
+        requests += await asyncio.gather(*(request_samples(problem, temperature, 1) for _ in range(missing)))
+        failure = next((answer for answers, _, _ in requests for answer in answers if app.is_failed_answer(answer)), None)
+        if failure is not None:
+            print(f"problem {problem_id} @ {temperature}: {failure} (will be retried on the next run)",
+                  file=sys.stderr)
+            return
+        rows = [{
+            "problem_id": problem_id,
+            "problem": problem,
+            "temperature": temperature,
+            "answer": answer,
+            "parsed_answer": app.parse_final_answer(answer),
+            "confidence": app.parse_confidence(answer),
+            "error": False,
+            "request_latency_s": round(latency, 3),
+            "request_samples": len(answers),
+            "request_prompt_tokens": usage.prompt_tokens,
+            "request_completion_tokens": usage.completion_tokens,
+        } for answers, usage, latency in requests for answer in answers]
+        for i, row in enumerate(rows):
+            row["iteration"] = i
+        checkpoint.write({"kind": "samples", "problem_id": problem_id, "temperature": temperature, "rows": rows})
+        done += 1
+        print(f"{done} sample batches done (problem {problem_id}, temperature {temperature})", file=sys.stderr)
+
+    async def run_problem(problem_id):
+        try:
+            problem = await get_problem(problem_id)
+        except RuntimeError as e:
+            print(f"problem {problem_id}: {e} (will be retried on the next run)", file=sys.stderr)
+            return
+        await asyncio.gather(*(run_samples(problem_id, problem, t) for t in config["temperatures"]))
+
+        complete = all((problem_id, t) in checkpoint.samples for t in config["temperatures"])
+        if config["aggregate"] and complete and problem_id not in checkpoint.aggregates:
+            answers = [row["answer"] for t in config["temperatures"] for row in checkpoint.samples[(problem_id, t)]]
+            consensus = app.local_consensus(answers)
+            row = {
+                "problem_id": problem_id, "problem": problem, "samples": len(answers),
+                "consensus_answer": consensus["answer"], "consensus_support": round(consensus["support"], 3),
+                "consensus_agreement": round(consensus["agreement"], 3),
+            }
+            if consensus["decisive"]:
+                # No need to pay for the aggregator
+                row.update(aggregated_by="consensus", aggregated_answer=consensus["answer"],
+                           confidence=round(consensus["mean_confidence"], 3), latency_s=0.0)
+            else:
+                async with semaphore:
+                    started = time.perf_counter()
+                    aggregated = await app.aggregate_answers(problem, answers, 0)
+                    latency = time.perf_counter() - started
+                if aggregated.startswith("Error in aggregation"):
+                    return
+                row.update(aggregated_by="llm", aggregated_answer=aggregated,
+                           confidence=app.parse_confidence(aggregated), latency_s=round(latency, 3))
+            checkpoint.write({"kind": "aggregate", "problem_id": problem_id, "row": row})
+
+    await asyncio.gather(*(run_problem(problem_id) for problem_id in range(problem_count)))
+
+
+def write_table(path, rows, columns):
+    if path.endswith(".parquet"):
+        try:
+            import pandas as pd
+            pd.DataFrame(rows, columns=columns).to_parquet(path, index=False)
+        except ImportError as e:
+            sys.exit(f"Writing Parquet needs pandas and pyarrow ({e}); use a .csv output or pip install pyarrow")
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    config = dict(DEFAULT_CONFIG)
+    if args.config:
+        with open(args.config) as f:
+            config.update(json.load(f))
+    config["temperatures"] = [float(t) for t in config["temperatures"]]
+    if args.no_batch:
+        config["batch"] = False
+
+    import app  # the Panel app module; importing it only sets up widgets, nothing is served
+
+    checkpoint = Checkpoint(args.checkpoint or args.out + ".checkpoint.jsonl")
+    try:
+        asyncio.run(run_batch(app, config, checkpoint))
+    finally:
+        checkpoint.close()
+
+    samples = [row for key in sorted(checkpoint.samples) for row in checkpoint.samples[key]]
+    write_table(args.out, samples, SAMPLE_COLUMNS)
+    print(f"Wrote {len(samples)} samples to {args.out}", file=sys.stderr)
+    if config["aggregate"] and checkpoint.aggregates:
+        stem, ext = os.path.splitext(args.out)
+        aggregates_path = f"{stem}_aggregates{ext}"
+        write_table(aggregates_path, [checkpoint.aggregates[k] for k in sorted(checkpoint.aggregates)], AGGREGATE_COLUMNS)
+        print(f"Wrote {len(checkpoint.aggregates)} aggregated answers to {aggregates_path}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
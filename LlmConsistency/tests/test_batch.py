@@ -0,0 +1,56 @@
+import asyncio
+import os
+import sys
+import types
+
+os.environ.setdefault("OPENAI_API_KEY", "not-needed")
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ["SAMPLE_CONCURRENCY"] = "4"
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app  # noqa: E402
+import batch  # noqa: E402
+
+
+def run(tmp_path, sample_answers, **config):
+    config = dict(batch.DEFAULT_CONFIG, problems=["What is 6 * 7?"], temperatures=[0.5], iterations=3,
+                  aggregate=False, **config)
+    checkpoint = batch.Checkpoint(str(tmp_path / "checkpoint.jsonl"))
+    asyncio.run(batch.run_batch(types.SimpleNamespace(**dict(vars(app), sample_answers=sample_answers)), config, checkpoint))
+    checkpoint.close()
+    return checkpoint
+
+
+def test_samples_a_server_leaves_out_are_requested_singly(tmp_path):
+    requested = []
+
+    async def ignores_n(problem, temperature, n=1):
+        requested.append(n)
+        missing = [f"{app.FAILED_ANSWER}: only 1 of {n} samples returned"] * (n - 1)
+        return ["The answer is 42\nConfidence: 0.9"] + missing, types.SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+
+    checkpoint = run(tmp_path, ignores_n)
+    assert sorted(requested) == [1, 1, 3]
+    rows = checkpoint.samples[(0, 0.5)]
+    assert [row["iteration"] for row in rows] == [0, 1, 2]
+    assert all(row["parsed_answer"] == "42" and not row["error"] for row in rows)
+
+
+def test_without_batch_every_sample_is_a_request(tmp_path):
+    requested = []
+
+    async def answer(problem, temperature, n=1):
+        requested.append(n)
+        return ["The answer is 42"] * n, types.SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+
+    run(tmp_path, answer, batch=False)
+    assert requested == [1, 1, 1]
+
+
+def test_incomplete_samples_are_not_checkpointed(tmp_path):
+    async def fails_singly(problem, temperature, n=1):
+        if n == 1:
+            return [f"{app.FAILED_ANSWER}: Error code: 429"], None
+        return ["The answer is 42"], types.SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+
+    assert (0, 0.5) not in run(tmp_path, fails_singly).samples
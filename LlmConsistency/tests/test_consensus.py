@@ -0,0 +1,48 @@
+import os
+import sys
+
+os.environ.setdefault("OPENAI_API_KEY", "not-needed")
+os.environ.setdefault("METRICS_PORT", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import app  # noqa: E402
+
+
+def test_failed_samples_do_not_vote():
+    answers = ["Error in answer: Error code: 429 - rate limited"] * 3
+    consensus = app.local_consensus(answers)
+    assert consensus["answer"] is None
+    assert consensus["samples"] == 0
+    assert consensus["failed"] == 3
+    assert not consensus["decisive"]
+
+
+def test_failed_samples_do_not_count_towards_min_samples():
+    answers = ["The answer is 7\nConfidence: 0.9"] * 2 + ["Error in answer: Error code: 500"]
+    consensus = app.local_consensus(answers)
+    assert consensus["answer"] == "7"
+    assert consensus["samples"] == 2
+    assert not consensus["decisive"]
+
+
+def test_unanimous_answers_are_decisive():
+    consensus = app.local_consensus(["Final answer: 1,000\nConfidence: 0.8"] * 3)
+    assert consensus["answer"] == "1000"
+    assert consensus["decisive"]
+
+
+def test_latex_answers_are_not_read_as_their_first_digit():
+    assert app.parse_final_answer(r"The answer is $\frac{1}{2}$") == "0.5"
+    assert app.parse_final_answer(r"The answer is $\frac{1}{3}$.") == "0.333333"
+    assert app.parse_final_answer("The final answer is 2^{10} = 1024") == "1024"
+    assert app.parse_final_answer("Final answer: 2^{10}") is None
+    assert app.parse_final_answer(r"The answer is \sqrt{2}") is None
+    answers = [r"The answer is $\frac{1}{2}$", r"The answer is $\frac{1}{3}$", "The answer is 2^{10}"]
+    assert not app.local_consensus([answer + "\nConfidence: 0.9" for answer in answers])["decisive"]
+
+
+def test_confidence_with_trailing_punctuation_or_as_percentage():
+    assert app.parse_confidence("The answer is 4.\nConfidence: 0.85.") == 0.85
+    assert app.parse_confidence("My confidence is 0.8.") == 0.8
+    assert app.parse_confidence("95%") == 0.95
+    assert app.parse_confidence("Confidence: 150%") is None
@@ -1,6 +1,15 @@
 import panel as pn
-from openai import OpenAI, OpenAIError
+from openai import AsyncOpenAI, OpenAIError
 import os
+import sys
+import asyncio
+import tempfile
+
+# Helpers shared with the other apps: ../shared in the repository, /opt/shared (on PYTHONPATH) in the image
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+from llm_common import (MessageLog, StreamPreview, cached_create, current_session_id,  # noqa: E402
+                        setup_completion_cache, setup_metrics, setup_request_scheduler,
+                        setup_session_store, stats_tab)
 
 pn.extension(notifications=True)  # Enable notifications
 
@@ -17,17 +26,83 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 if not OPENAI_API_KEY:
     raise ValueError("Please set the OPENAI_API_KEY environment variable.")
 
-# Initialize OpenAI client
-try:
-    client = OpenAI(api_key=OPENAI_API_KEY)  # Ensure API key is passed
-except OpenAIError as e:
-    pn.state.notifications.error(f"OpenAI initialization failed: {e}")
-    raise
+# Initialize the OpenAI client once per server process; every session shares it and its connection pool.
+# It is async so a slow completion doesn't block the server for other sessions.
+if "openai_client" not in pn.state.cache:
+    try:
+        pn.state.cache["openai_client"] = AsyncOpenAI(api_key=OPENAI_API_KEY)  # Ensure API key is passed
+    except OpenAIError as e:
+        pn.state.notifications.error(f"OpenAI initialization failed: {e}")
+        raise
+client = pn.state.cache["openai_client"]
+
+MODEL = os.getenv('OPENAI_MODEL', 'gpt-4')
+
+# Stream replies token by token (set STREAM_REPLIES=0 to wait for complete replies)
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '1') != '0'
+
+# Messages kept rendered in the chat pane; older ones are behind "Show earlier"
+CHAT_WINDOW = int(os.getenv('CHAT_WINDOW', '200'))
+
+# Prompt size stays bounded: each call sees the rolling summary plus the recent messages.
+# Once CONTEXT_WINDOW + SUMMARY_CHUNK messages are unsummarized, the oldest SUMMARY_CHUNK
+# are folded into the summary (CONTEXT_WINDOW=0 sends the full history every time)
+CONTEXT_WINDOW = int(os.getenv('CONTEXT_WINDOW', '12'))
+SUMMARY_CHUNK = int(os.getenv('SUMMARY_CHUNK', '8'))
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '400'))
+
+# USD per 1000 tokens, for the cost estimate of a dialogue
+PROMPT_PRICE_PER_1K = float(os.getenv('PROMPT_PRICE_PER_1K', '0.03'))
+COMPLETION_PRICE_PER_1K = float(os.getenv('COMPLETION_PRICE_PER_1K', '0.06'))
+
+# Dialogues are appended to one JSONL file per session under SESSION_DIR (empty disables) and
+# resumed from the ?session= URL parameter; fsync is batched every SESSION_FSYNC_INTERVAL seconds
+SESSION_DIR = os.getenv('SESSION_DIR', os.path.join(tempfile.gettempdir(), 'llmconversation_sessions'))
+SESSION_FSYNC_INTERVAL = float(os.getenv('SESSION_FSYNC_INTERVAL', '0.5'))
+
+# -------------------------------------------------------------------
+# Metrics, Completion Cache and Request Scheduler (shared/llm_common.py)
+# -------------------------------------------------------------------
+setup_metrics()
+setup_completion_cache()
+request_scheduler = setup_request_scheduler(client)
+
+# -------------------------------------------------------------------
+# Session Store (shared/llm_common.py)
+# -------------------------------------------------------------------
+session_store = setup_session_store(SESSION_DIR, SESSION_FSYNC_INTERVAL)
+
+class UsageMeter:
+    """Tokens and estimated cost of this session's dialogue, including summary requests."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.last_prompt_tokens = 0
+
+    def add(self, usage):
+        self.requests += 1
+        self.prompt_tokens += usage.prompt_tokens
+        self.completion_tokens += usage.completion_tokens
+        self.last_prompt_tokens = usage.prompt_tokens
+
+    @property
+    def cost(self):
+        return (self.prompt_tokens * PROMPT_PRICE_PER_1K + self.completion_tokens * COMPLETION_PRICE_PER_1K) / 1000
+
+    def markdown(self):
+        return (f"**Tokens:** {self.prompt_tokens:,} prompt + {self.completion_tokens:,} completion "
+                f"in {self.requests} requests (last prompt {self.last_prompt_tokens:,}) | "
+                f"**Estimated cost:** ${self.cost:.4f}")
 
 # Define Panel widgets
-chat_history = pn.pane.Markdown("### Chat History\n\n", width=600, height=400)
+chat_log = MessageLog("### Chat History", window=CHAT_WINDOW, width=600, height=400, scroll=True, auto_scroll_limit=100)
 chat_history_container = pn.Row(
-    chat_history,
+    chat_log,
     sizing_mode='stretch_both',
     css_classes=['scrollable']
 )
@@ -35,6 +110,15 @@ chat_history_container = pn.Row(
 send_button = pn.widgets.Button(name='Send Next Turn', button_type='primary')
 clear_button = pn.widgets.Button(name='Clear', button_type='warning')
 
+# Autonomous mode: run turns until the count, the budget or the stop phrase is reached
+turns_input = pn.widgets.IntInput(name='Turns', value=10, start=1, width=100)
+budget_input = pn.widgets.FloatInput(name='Budget (USD, 0 = none)', value=1.0, start=0, step=0.5, width=160)
+stop_phrase_input = pn.widgets.TextInput(name='Stop phrase (optional)', placeholder='e.g. GOODBYE', width=200)
+run_button = pn.widgets.Button(name='Run Turns', button_type='success')
+stop_button = pn.widgets.Button(name='Stop', button_type='danger', disabled=True)
+usage_meter = UsageMeter()
+usage_pane = pn.pane.Markdown(usage_meter.markdown(), sizing_mode='stretch_width')
+
 # Two distinct system prompts for our two LLM "instances"
 system_prompt_llm1 = {
     "role": "system",
@@ -54,69 +138,245 @@ system_prompt_llm2 = {
 
 # Shared conversation state (excluding each LLM's system prompt).
 conversation = []
+# Rolling summary of conversation[:summary["upto"]], the messages no longer sent verbatim
+summary = {"text": "", "upto": 0}
+# The autonomous run of this session, so the stop button can cancel it
+autonomous_run = {"task": None}
+# The stored session this browser session writes to; "count" numbers its messages
+session = {"id": current_session_id(), "count": 0}
+
+def persist(record):
+    if session_store is not None:
+        session_store.append(session["id"], record)
+
+def persist_message(message):
+    persist({"kind": "message", "n": session["count"], "message": message})
+    session["count"] += 1
+
+def resume_session():
+    """
+    Loads a stored dialogue: the rolling summary and the messages after it, i.e. exactly
+    what the next prompt needs, however long the dialogue has become.
+    """
+    if session_store is None:
+        return
+    stored_summary, records = session_store.tail(session["id"])
+    if stored_summary is not None:
+        summary.update(text=stored_summary["text"], upto=0)
+    if not records:
+        return
+    session["count"] = records[-1]["n"] + 1
+    if records[0]["n"]:
+        chat_log.append(f"*Resumed session: {records[0]['n']} earlier messages are folded into the summary.*")
+    for record in records:
+        conversation.append(record["message"])
+        chat_log.append(f"**{record['message']['name']}:** {record['message']['content']}")
+# One turn at a time per session, since both LLMs append to the shared conversation
+turn_lock = asyncio.Lock()
+
+async def complete(**params):
+    """
+    Calls the chat completions API through the request scheduler without streaming and
+    returns the reply text and token usage. Requests allowed by LLM_CACHE are answered from
+    the completion cache when possible; cached replies come back with usage None since they
+    cost nothing.
+    """
+    response, cached = await cached_create(request_scheduler, **params)
+    return response.choices[0].message.content.strip(), None if cached else response.usage
+
+async def stream_completion(label, **params):
+    """
+    Calls the chat completions API through the request scheduler and returns the reply text.
+    With STREAM_REPLIES the reply is rendered in the chat pane under `label` as tokens
+    arrive; the preview is removed again and the caller appends the final reply.
+    Without a label the request is not streamed. Token usage is added to the usage meter.
+    Requests allowed by LLM_CACHE are answered from the completion cache when possible.
+    """
+    if label is None or not STREAM_REPLIES:
+        reply, usage = await complete(**params)
+        if usage:
+            usage_meter.add(usage)
+        return reply
+
+    with StreamPreview(chat_log, label) as preview:
+        response, cached = await cached_create(request_scheduler, on_content=preview, **params)
+    if response.usage and not cached:
+        usage_meter.add(response.usage)
+    return response.choices[0].message.content.strip()
+
+def build_messages(system_prompt, summary_text, recent):
+    """The prompt for one LLM: its system prompt, the rolling summary and the unsummarized messages."""
+    messages = [system_prompt]
+    if summary_text:
+        messages.append({"role": "system", "content": f"Summary of the conversation so far:\n{summary_text}"})
+    return messages + recent
+
+def summary_due(history, upto):
+    """Whether the unsummarized messages history[upto:] have outgrown the context window."""
+    return bool(CONTEXT_WINDOW) and len(history) - upto >= CONTEXT_WINDOW + SUMMARY_CHUNK
 
-def generate_next_turn(_=None):
+def summary_request(summary_text, messages, model=MODEL):
+    """Request parameters that merge `messages` into the rolling summary."""
+    transcript = "\n".join(f"{m['name']}: {m['content']}" for m in messages)
+    return dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": (
+                "You maintain a running summary of a conversation between LLM1 and LLM2. "
+                "Merge the new messages into the summary. Keep names, facts, open questions and "
+                f"the tone; stay under {SUMMARY_MAX_TOKENS * 3 // 4} words."
+            )},
+            {"role": "user", "content": f"Summary so far:\n{summary_text or '(none)'}\n\nNew messages:\n{transcript}"},
+        ],
+        temperature=0,
+        max_tokens=SUMMARY_MAX_TOKENS,
+    )
+
+def context_messages(system_prompt):
+    return build_messages(system_prompt, summary["text"], conversation[summary["upto"]:])
+
+async def update_summary():
+    """Folds the oldest unsummarized messages into the rolling summary once the window overflows."""
+    if not summary_due(conversation, summary["upto"]):
+        return
+    upto = summary["upto"] + SUMMARY_CHUNK
+    summary["text"] = await stream_completion(None, **summary_request(summary["text"], conversation[summary["upto"]:upto]))
+    summary["upto"] = upto
+    # The stored summary counts messages over the whole session, not this process's list
+    persist({"kind": "summary", "text": summary["text"], "upto": session["count"] - (len(conversation) - upto)})
+
+async def run_turn():
     """
     Each time this is called, we:
-      1) Call LLM1 with [system_prompt_llm1] + conversation
+      1) Call LLM1 with [system_prompt_llm1] + summary + recent conversation
       2) Append its response to the conversation (labeled as LLM1)
-      3) Call LLM2 with [system_prompt_llm2] + updated conversation
+      3) Call LLM2 with [system_prompt_llm2] + summary + updated recent conversation
       4) Append its response to the conversation (labeled as LLM2)
+      5) Fold messages that left the context window into the summary
+    Returns the two replies, or None if a request failed.
     """
-    global conversation
-
     # --- LLM1 turn ---
     try:
-        messages_llm1 = [system_prompt_llm1] + conversation
-        response1 = client.chat.completions.create(
-            model="gpt-4",
+        messages_llm1 = context_messages(system_prompt_llm1)
+        llm1_text = await stream_completion(
+            "**LLM1:**",
+            model=MODEL,
             messages=messages_llm1,
             temperature = 0
         )
     except OpenAIError as e:
         pn.state.notifications.error(f"OpenAI API error (LLM1): {e}")
-        return
+        return None
 
-    llm1_text = response1.choices[0].message.content.strip()
     # Append LLM1’s text to chat display
-    chat_history.object += f"**LLM1:** {llm1_text}\n\n"
+    chat_log.append(f"**LLM1:** {llm1_text}")
     # Add to conversation as if "assistant" from LLM1
     conversation.append({"role": "assistant", "content": llm1_text, "name": "LLM1"})
+    persist_message(conversation[-1])
+    usage_pane.object = usage_meter.markdown()
 
     # --- LLM2 turn ---
     try:
-        messages_llm2 = [system_prompt_llm2] + conversation
-        response2 = client.chat.completions.create(
-            model="gpt-4",
+        messages_llm2 = context_messages(system_prompt_llm2)
+        llm2_text = await stream_completion(
+            "**LLM2:**",
+            model=MODEL,
             messages=messages_llm2,
             temperature = 1
         )
     except OpenAIError as e:
         pn.state.notifications.error(f"OpenAI API error (LLM2): {e}")
-        return
+        return None
 
-    llm2_text = response2.choices[0].message.content.strip()
     # Append LLM2’s text to chat display
-    chat_history.object += f"**LLM2:** {llm2_text}\n\n"
+    chat_log.append(f"**LLM2:** {llm2_text}")
     # Add to conversation as if "assistant" from LLM2
     conversation.append({"role": "assistant", "content": llm2_text, "name": "LLM2"})
+    persist_message(conversation[-1])
+
+    try:
+        await update_summary()
+    except OpenAIError as e:
+        # The next turn retries; until then the prompt is a little longer
+        pn.state.notifications.warning(f"OpenAI API error (summary): {e}")
+    usage_pane.object = usage_meter.markdown()
+    return llm1_text, llm2_text
+
+async def generate_next_turn(_=None):
+    if turn_lock.locked():
+        pn.state.notifications.warning("Please wait for the current turn to finish.")
+        return
+    async with turn_lock:
+        await run_turn()
+
+async def run_autonomous(_=None):
+    """Runs turns back to back until the turn count, the budget or the stop phrase is reached."""
+    if turn_lock.locked():
+        pn.state.notifications.warning("Please wait for the current turn to finish.")
+        return
+    autonomous_run["task"] = asyncio.current_task()
+    send_button.disabled = run_button.disabled = True
+    stop_button.disabled = False
+    turns, budget = turns_input.value, budget_input.value
+    stop_phrase = stop_phrase_input.value.strip().lower()
+    start_cost = usage_meter.cost
+    reason = f"{turns} turns done"
+    try:
+        for turn in range(turns):
+            async with turn_lock:
+                replies = await run_turn()
+            if replies is None:
+                reason = f"stopped after {turn} turns by an API error"
+                break
+            if stop_phrase and any(stop_phrase in reply.lower() for reply in replies):
+                reason = f"stop phrase after {turn + 1} turns"
+                break
+            if budget and usage_meter.cost - start_cost >= budget:
+                reason = f"budget of ${budget:.2f} reached after {turn + 1} turns"
+                break
+    except asyncio.CancelledError:
+        reason = "stopped"
+    finally:
+        autonomous_run["task"] = None
+        send_button.disabled = run_button.disabled = False
+        stop_button.disabled = True
+        usage_pane.object = usage_meter.markdown()
+    pn.state.notifications.info(f"Autonomous run {reason}.")
+
+def stop_autonomous(_=None):
+    if autonomous_run["task"] is not None:
+        autonomous_run["task"].cancel()
 
 def clear_chat(_=None):
     global conversation
+    stop_autonomous()
     conversation = []
-    chat_history.object = "### Chat History\n\n"
+    summary.update(text="", upto=0)
+    persist({"kind": "clear"})
+    session["count"] = 0
+    usage_meter.reset()
+    usage_pane.object = usage_meter.markdown()
+    chat_log.clear()
+
+resume_session()
 
 # Bind events
 send_button.on_click(generate_next_turn)
 clear_button.on_click(clear_chat)
+run_button.on_click(run_autonomous)
+stop_button.on_click(stop_autonomous)
 
 # Layout the app
 layout = pn.Column(
     chat_history_container,
     pn.Row(send_button, clear_button, sizing_mode='stretch_width'),
+    pn.Row(turns_input, budget_input, stop_phrase_input, run_button, stop_button, sizing_mode='stretch_width'),
+    usage_pane,
     sizing_mode='stretch_width'
 )
 
+layout = stats_tab(layout, "Chat", [request_scheduler.stats_markdown])
+
 layout.servable()
 
 if __name__ == '__main__':
@@ -0,0 +1,296 @@
+"""
+Runs many LLM1/LLM2 dialogues concurrently without the UI, one per configuration and repeat,
+and compares them.
+
+Every message is appended to a JSONL transcript as soon as it arrives, followed by one
+"dialogue" record when the dialogue ends. Re-running the same command skips the dialogues
+that already finished; interrupted and failed ones (e.g. rate limited) start over. A summary table (turn latency, token
+usage, reply length, cost per configuration) is written next to the transcript and printed.
+
+    python sweep.py --config sweep.json --out transcripts.jsonl
+    python sweep.py --config sweep.json --out transcripts.jsonl --base-url http://localhost:8000/v1 --concurrency 16
+
+The config is a JSON object; every key is optional (defaults in DEFAULT_CONFIG and DEFAULT_DIALOGUE):
+
+    {"turns": 10, "repeats": 3,
+     "base": {"model": "gpt-4", "prompt2": "You are LLM2, a skeptic ..."},
+     "grid": {"temperature1": [0, 0.7], "temperature2": [0.7, 1.2]},
+     "configs": [{"name": "terse", "prompt1": "You are LLM1. Answer in one sentence."}]}
+
+Each entry of "configs" (default: one empty entry) is merged over "base" and then expanded
+over every combination in "grid", so the example above runs 1 x 4 configurations x 3 repeats.
+Dialogue keys are model (or model1/model2), prompt1/prompt2, temperature1/temperature2,
+turns and stop_phrase.
+"""
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+from openai import OpenAIError
+
+DEFAULT_CONFIG = {
+    "turns": 10,
+    "repeats": 1,
+    "base": {},
+    "grid": {},
+    "configs": [{}],
+}
+
+# The app's own setup: both prompts as in app.py, LLM1 at temperature 0 and LLM2 at 1
+DEFAULT_DIALOGUE = {
+    "temperature1": 0,
+    "temperature2": 1,
+    "stop_phrase": "",
+}
+
+SUMMARY_COLUMNS = [
+    "config", "dialogues", "errors", "turns", "turn_latency_mean_s", "turn_latency_p95_s",
+    "prompt_tokens_per_turn", "completion_tokens_per_turn", "reply_words_mean", "cost_usd",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run many LLM1/LLM2 dialogues concurrently without the UI.")
+    parser.add_argument("--config", help="JSON sweep config (see module docstring)")
+    parser.add_argument("--out", required=True, help="JSONL transcript file; appended to and resumed from")
+    parser.add_argument("--summary", help="Summary table, .csv (default: <out>_summary.csv)")
+    parser.add_argument("--base-url", help="OpenAI-compatible endpoint, e.g. a local stand-in server")
+    parser.add_argument("--api-key", help="API key (default: OPENAI_API_KEY; a dummy key with --base-url)")
+    parser.add_argument("--model", help="Default model (default: OPENAI_MODEL or gpt-4)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Dialogues running at once")
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    """The app reads its settings from the environment when imported, so set them up first."""
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "not-needed")
+    if args.api_key:
+        os.environ["OPENAI_API_KEY"] = args.api_key
+    if args.model:
+        os.environ["OPENAI_MODEL"] = args.model
+    # Don't compete with a running app for the metrics port
+    os.environ.setdefault("METRICS_PORT", "0")
+
+
+def expand_configs(config, app):
+    """All dialogue configurations of the sweep, each with a unique name."""
+    defaults = dict(DEFAULT_DIALOGUE, model=app.MODEL, turns=config["turns"],
+                    prompt1=app.system_prompt_llm1["content"], prompt2=app.system_prompt_llm2["content"])
+    grid_keys = sorted(config["grid"])
+    dialogues = []
+    for entry in config["configs"]:
+        for values in itertools.product(*(config["grid"][key] for key in grid_keys)):
+            dialogue = {**defaults, **config["base"], **entry, **dict(zip(grid_keys, values))}
+            dialogue.setdefault("model1", dialogue["model"])
+            dialogue.setdefault("model2", dialogue["model"])
+            parts = [entry["name"]] if "name" in entry else []
+            parts += [f"{key}={value}" for key, value in zip(grid_keys, values)]
+            dialogue["name"] = " ".join(parts) or "default"
+            dialogues.append(dialogue)
+    names = [dialogue["name"] for dialogue in dialogues]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        sys.exit(f"Configurations need distinct names: {', '.join(sorted(duplicates))}")
+    return dialogues
+
+
+class Transcript:
+    """
+    Append-only JSONL log: one "message" record per reply and one "dialogue" record per
+    ended dialogue. Records carry the id of their attempt, so the messages of an
+    interrupted or failed attempt can be told apart from those of the rerun.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.finished = {}  # (config name, repeat) -> latest dialogue record, failed or not
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # a line cut short by the interruption
+                    if record["kind"] == "dialogue":
+                        self.finished[(record["config"], record["repeat"])] = record
+        self._file = open(path, "a")
+
+    def succeeded(self, config, repeat):
+        """Whether the dialogue ended without an error; failed ones are run again."""
+        record = self.finished.get((config, repeat))
+        return record is not None and record["error"] is None
+
+    def write(self, record):
+        if record["kind"] == "dialogue":
+            self.finished[(record["config"], record["repeat"])] = record
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+async def run_dialogue(app, dialogue, repeat, transcript):
+    """Plays one dialogue with the app's bounded context and rolling summary; returns its record."""
+    attempt = uuid.uuid4().hex
+    speakers = [
+        ("LLM1", {"role": "system", "content": dialogue["prompt1"]}, dialogue["model1"], dialogue["temperature1"]),
+        ("LLM2", {"role": "system", "content": dialogue["prompt2"]}, dialogue["model2"], dialogue["temperature2"]),
+    ]
+    stop_phrase = dialogue["stop_phrase"].strip().lower()
+    history, summary_text, upto = [], "", 0
+    turns, turn_latencies = [], []
+    tokens = {"prompt": 0, "completion": 0}
+    error, stop_reason = None, "turns"
+
+    def count(usage):
+        if usage:
+            tokens["prompt"] += usage.prompt_tokens
+            tokens["completion"] += usage.completion_tokens
+
+    try:
+        for turn in range(dialogue["turns"]):
+            turn_started = time.perf_counter()
+            replies = []
+            for name, system_prompt, model, temperature in speakers:
+                started = time.perf_counter()
+                reply, usage = await app.complete(
+                    model=model,
+                    messages=app.build_messages(system_prompt, summary_text, history[upto:]),
+                    temperature=temperature,
+                )
+                count(usage)
+                history.append({"role": "assistant", "content": reply, "name": name})
+                replies.append(reply)
+                transcript.write({
+                    "kind": "message", "attempt": attempt, "config": dialogue["name"], "repeat": repeat,
+                    "turn": turn, "speaker": name, "content": reply,
+                    "latency_s": round(time.perf_counter() - started, 3),
+                    "prompt_tokens": usage.prompt_tokens if usage else 0,
+                    "completion_tokens": usage.completion_tokens if usage else 0,
+                })
+            if app.summary_due(history, upto):
+                summary_text, usage = await app.complete(
+                    **app.summary_request(summary_text, history[upto:upto + app.SUMMARY_CHUNK], dialogue["model"])
+                )
+                count(usage)
+                upto += app.SUMMARY_CHUNK
+            turn_latencies.append(time.perf_counter() - turn_started)
+            turns.append(replies)
+            if stop_phrase and any(stop_phrase in reply.lower() for reply in replies):
+                stop_reason = "stop_phrase"
+                break
+    except OpenAIError as e:
+        error, stop_reason = str(e), "error"
+    except Exception as e:
+        # Anything else (a malformed response, a bug) fails this dialogue, not the whole sweep
+        error, stop_reason = f"{type(e).__name__}: {e}", "error"
+
+    record = {
+        "kind": "dialogue", "attempt": attempt, "config": dialogue["name"], "repeat": repeat,
+        "settings": {k: v for k, v in dialogue.items() if k != "name"},
+        "turns": len(turns), "stop_reason": stop_reason, "error": error,
+        "turn_latencies_s": [round(latency, 3) for latency in turn_latencies],
+        "prompt_tokens": tokens["prompt"], "completion_tokens": tokens["completion"],
+        "reply_words": [len(reply.split()) for replies in turns for reply in replies],
+    }
+    transcript.write(record)
+    return record
+
+
+async def run_sweep(app, dialogues, repeats, transcript, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    todo = [(dialogue, repeat) for dialogue in dialogues for repeat in range(repeats)
+            if not transcript.succeeded(dialogue["name"], repeat)]
+    done = 0
+
+    async def run(dialogue, repeat):
+        nonlocal done
+        async with semaphore:
+            record = await run_dialogue(app, dialogue, repeat, transcript)
+        done += 1
+        status = f"error: {record['error']}" if record["error"] else f"{record['turns']} turns"
+        print(f"{done}/{len(todo)} {dialogue['name']} #{repeat}: {status}", file=sys.stderr)
+
+    await asyncio.gather(*(run(dialogue, repeat) for dialogue, repeat in todo))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(app, dialogues, records):
+    """One row per configuration, over its finished dialogues."""
+    rows = []
+    for dialogue in dialogues:
+        runs = [record for record in records if record["config"] == dialogue["name"]]
+        latencies = [latency for record in runs for latency in record["turn_latencies_s"]]
+        words = [count for record in runs for count in record["reply_words"]]
+        turns = sum(record["turns"] for record in runs)
+        prompt_tokens = sum(record["prompt_tokens"] for record in runs)
+        completion_tokens = sum(record["completion_tokens"] for record in runs)
+        rows.append({
+            "config": dialogue["name"],
+            "dialogues": len(runs),
+            "errors": sum(record["error"] is not None for record in runs),
+            "turns": turns,
+            "turn_latency_mean_s": round(statistics.mean(latencies), 3) if latencies else None,
+            "turn_latency_p95_s": round(percentile(latencies, 0.95), 3) if latencies else None,
+            "prompt_tokens_per_turn": round(prompt_tokens / turns, 1) if turns else None,
+            "completion_tokens_per_turn": round(completion_tokens / turns, 1) if turns else None,
+            "reply_words_mean": round(statistics.mean(words), 1) if words else None,
+            "cost_usd": round((prompt_tokens * app.PROMPT_PRICE_PER_1K
+                               + completion_tokens * app.COMPLETION_PRICE_PER_1K) / 1000, 4),
+        })
+    return rows
+
+
+def markdown_table(rows):
+    lines = ["| " + " | ".join(SUMMARY_COLUMNS) + " |", "|" + "---|" * len(SUMMARY_COLUMNS)]
+    for row in rows:
+        lines.append("| " + " | ".join("" if row[c] is None else str(row[c]) for c in SUMMARY_COLUMNS) + " |")
+    return "\n".join(lines)
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    config = dict(DEFAULT_CONFIG)
+    if args.config:
+        with open(args.config) as f:
+            config.update(json.load(f))
+
+    import app  # the Panel app module; importing it only sets up widgets, nothing is served
+
+    dialogues = expand_configs(config, app)
+    transcript = Transcript(args.out)
+    try:
+        asyncio.run(run_sweep(app, dialogues, config["repeats"], transcript, args.concurrency))
+    finally:
+        transcript.close()
+
+    names = {dialogue["name"] for dialogue in dialogues}
+    records = [record for (name, repeat), record in sorted(transcript.finished.items())
+               if name in names and repeat < config["repeats"]]
+    rows = summarize(app, dialogues, records)
+    summary_path = args.summary or os.path.splitext(args.out)[0] + "_summary.csv"
+    with open(summary_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(markdown_table(rows))
+    print(f"Wrote {len(records)} dialogues to {args.out} and the summary to {summary_path}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
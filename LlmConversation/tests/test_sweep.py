@@ -0,0 +1,68 @@
+import asyncio
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import sweep  # noqa: E402
+
+
+async def complete(model, messages, temperature):
+    if model == "broken":
+        raise KeyError("choices")
+    return "fine", None
+
+
+fake_app = types.SimpleNamespace(
+    complete=complete,
+    build_messages=lambda system_prompt, summary_text, history: [system_prompt, *history],
+    summary_due=lambda history, upto: False,
+)
+
+
+def dialogue(name, model):
+    return dict(sweep.DEFAULT_DIALOGUE, name=name, model=model, model1=model, model2=model,
+                prompt1="one", prompt2="two", turns=2)
+
+
+def test_a_failing_dialogue_does_not_stop_the_sweep(tmp_path):
+    transcript = sweep.Transcript(str(tmp_path / "transcript.jsonl"))
+    dialogues = [dialogue("broken", "broken"), dialogue("ok", "fine")]
+    asyncio.run(sweep.run_sweep(fake_app, dialogues, 2, transcript, 4))
+    transcript.close()
+
+    finished = sweep.Transcript(str(tmp_path / "transcript.jsonl")).finished
+    assert sorted(finished) == [("broken", 0), ("broken", 1), ("ok", 0), ("ok", 1)]
+    assert finished[("broken", 0)]["stop_reason"] == "error"
+    assert finished[("broken", 0)]["error"] == "KeyError: 'choices'"
+    assert finished[("ok", 1)]["turns"] == 2 and finished[("ok", 1)]["error"] is None
+
+
+def test_failed_dialogues_are_retried_on_the_next_run(tmp_path):
+    path = str(tmp_path / "transcript.jsonl")
+    transcript = sweep.Transcript(path)
+    asyncio.run(sweep.run_sweep(fake_app, [dialogue("broken", "broken"), dialogue("ok", "fine")], 1, transcript, 4))
+    transcript.close()
+
+    calls = []
+
+    async def recovered(model, messages, temperature):
+        calls.append(model)
+        return "fine", None
+
+    transcript = sweep.Transcript(path)
+    asyncio.run(sweep.run_sweep(types.SimpleNamespace(**dict(vars(fake_app), complete=recovered)),
+                                [dialogue("broken", "broken"), dialogue("ok", "fine")], 1, transcript, 4))
+    transcript.close()
+    assert set(calls) == {"broken"}
+    assert sweep.Transcript(path).finished[("broken", 0)]["error"] is None
+
+
+def test_entries_and_grid_override_base():
+    app = types.SimpleNamespace(MODEL="gpt-4", system_prompt_llm1={"content": "one"},
+                                system_prompt_llm2={"content": "two"})
+    config = dict(sweep.DEFAULT_CONFIG, base={"prompt2": "base", "temperature1": 0.5},
+                  grid={"temperature1": [0, 1]}, configs=[{"name": "terse", "prompt2": "entry"}])
+    dialogues = sweep.expand_configs(config, app)
+    assert [(d["prompt2"], d["temperature1"]) for d in dialogues] == [("entry", 0), ("entry", 1)]
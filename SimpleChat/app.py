@@ -1,6 +1,17 @@
 import panel as pn
-from openai import OpenAI, OpenAIError
+from openai import AsyncOpenAI, OpenAIError
 import os
+import sys
+import time
+import asyncio
+import tempfile
+from collections import OrderedDict, deque
+from prometheus_client import Counter, Gauge, Histogram
+
+# Helpers shared with the other apps: ../shared in the repository, /opt/shared (on PYTHONPATH) in the image
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shared"))
+from llm_common import (LATENCY_BUCKETS, MessageLog, StreamPreview, cached_create, current_session_id,  # noqa: E402
+                        setup_completion_cache, setup_metrics, setup_session_store, stats_tab)
 
 pn.extension()
 
@@ -17,17 +28,203 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 if not OPENAI_API_KEY:
     raise ValueError("Please set the OPENAI_API_KEY environment variable.")
 
-# Initialize OpenAI client
-try:
-    client = OpenAI()
-except OpenAIError as e:
-    pn.state.notifications.error(f"OpenAI initialization failed: {e}")
-    raise
+# Initialize the OpenAI client once per server process; every session shares it and its connection pool.
+# It is async so a slow completion doesn't block the server for other sessions.
+if "openai_client" not in pn.state.cache:
+    try:
+        pn.state.cache["openai_client"] = AsyncOpenAI()
+    except OpenAIError as e:
+        pn.state.notifications.error(f"OpenAI initialization failed: {e}")
+        raise
+client = pn.state.cache["openai_client"]
+
+# Stream replies token by token (set STREAM_REPLIES=0 to wait for complete replies)
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '1') != '0'
+
+# Messages kept rendered in the chat pane; older ones are behind "Show earlier"
+CHAT_WINDOW = int(os.getenv('CHAT_WINDOW', '200'))
+
+# Admission control shared by all sessions: completions in flight at once, requests allowed to
+# wait for one (beyond that they are turned away as busy), in-flight completions per user and
+# the longest a request waits in the queue before it is turned away
+MAX_INFLIGHT = int(os.getenv('MAX_INFLIGHT', '8'))
+MAX_QUEUE = int(os.getenv('MAX_QUEUE', '32'))
+MAX_INFLIGHT_PER_USER = int(os.getenv('MAX_INFLIGHT_PER_USER', '2'))
+QUEUE_TIMEOUT = float(os.getenv('QUEUE_TIMEOUT', '30'))
+
+# Conversations are appended to one JSONL file per session under SESSION_DIR (empty disables) and
+# resumed from the ?session= URL parameter with the last SESSION_RESUME_MESSAGES messages;
+# fsync is batched every SESSION_FSYNC_INTERVAL seconds
+SESSION_DIR = os.getenv('SESSION_DIR', os.path.join(tempfile.gettempdir(), 'simplechat_sessions'))
+SESSION_FSYNC_INTERVAL = float(os.getenv('SESSION_FSYNC_INTERVAL', '0.5'))
+SESSION_RESUME_MESSAGES = int(os.getenv('SESSION_RESUME_MESSAGES', str(CHAT_WINDOW)))
+
+# -------------------------------------------------------------------
+# Metrics and Completion Cache (shared/llm_common.py)
+# -------------------------------------------------------------------
+def create_admission_metrics():
+    """Admission control metrics, next to the shared completion metrics."""
+    return {
+        "queue_wait": Histogram("llm_queue_wait_seconds", "Time requests waited for a completion slot",
+                                buckets=LATENCY_BUCKETS),
+        "queue_depth": Gauge("llm_queue_depth", "Requests waiting for a completion slot"),
+        "inflight": Gauge("llm_inflight_requests", "Completions in flight"),
+        "shed": Counter("llm_requests_shed", "Requests turned away as busy", ["reason"]),
+    }
+
+metrics = setup_metrics(create_admission_metrics)
+setup_completion_cache()
+
+# -------------------------------------------------------------------
+# Admission Control
+# -------------------------------------------------------------------
+class ServerBusy(Exception):
+    """Raised when a request is turned away because the queue is full or it waited too long."""
+
+class AdmissionController:
+    """
+    Bounded pool of in-flight completions shared by every session of this server process.
+
+    A request starts right away while a slot is free, its user is below the per-user limit
+    and has nothing queued already; requests of other users that wait for their own limit
+    don't hold it up. Otherwise it queues behind the other requests of the same user, and
+    users take turns: a freed slot goes to the next user in round-robin order who is below
+    the per-user limit. When the queue is full, or a request has waited `queue_timeout`
+    seconds, it is shed with ServerBusy so the client gets a quick answer instead of a timeout.
+    """
+
+    def __init__(self, max_inflight, max_queue, max_per_user, queue_timeout):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.queue_timeout = queue_timeout
+        self.inflight = {}              # user -> completions in flight
+        self.queues = OrderedDict()     # user -> deque of futures, in round-robin order
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = {"queue_full": 0, "timeout": 0}
+
+    def _may_start(self, user):
+        return (sum(self.inflight.values()) < self.max_inflight
+                and self.inflight.get(user, 0) < self.max_per_user)
+
+    def _start(self, user):
+        self.inflight[user] = self.inflight.get(user, 0) + 1
+        self.admitted += 1
+        self._update_gauges()
+
+    def _update_gauges(self):
+        metrics["queue_depth"].set(self.waiting)
+        metrics["inflight"].set(sum(self.inflight.values()))
+
+    def _shed(self, reason):
+        self.shed[reason] += 1
+        metrics["shed"].labels(reason=reason).inc()
+        raise ServerBusy(reason)
+
+    def _dispatch(self):
+        """Hands free slots to waiting requests, one user at a time."""
+        granted = True
+        while granted and sum(self.inflight.values()) < self.max_inflight:
+            granted = False
+            for user in list(self.queues):
+                if not self._may_start(user):
+                    continue
+                waiter = self.queues[user].popleft()
+                self.waiting -= 1
+                if not self.queues[user]:
+                    del self.queues[user]
+                else:
+                    self.queues.move_to_end(user)  # the next slot goes to someone else
+                if waiter.done():
+                    continue  # gave up waiting in the meantime
+                self._start(user)
+                waiter.set_result(None)
+                granted = True
+                break
+        self._update_gauges()
+
+    def must_wait(self, user):
+        """Whether a request of this user would queue instead of starting right away."""
+        return user in self.queues or not self._may_start(user)
+
+    async def acquire(self, user):
+        """Waits for a completion slot; raises ServerBusy if the request is shed."""
+        started = time.perf_counter()
+        if not self.must_wait(user):
+            self._start(user)
+            metrics["queue_wait"].observe(0)
+            return
+        if self.waiting >= self.max_queue:
+            self._shed("queue_full")
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user, deque()).append(waiter)
+        self.waiting += 1
+        self._dispatch()  # picks this request up at once if a slot it may use is free
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                self.release(user)  # the slot arrived just as we gave up
+            else:
+                waiter.cancel()
+                self._forget(user, waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._shed("timeout")
+        metrics["queue_wait"].observe(time.perf_counter() - started)
+
+    def _forget(self, user, waiter):
+        queue = self.queues.get(user)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.waiting -= 1
+            if not queue:
+                del self.queues[user]
+        self._update_gauges()
+
+    def release(self, user):
+        self.inflight[user] -= 1
+        if not self.inflight[user]:
+            del self.inflight[user]
+        self._dispatch()
+
+    def stats_markdown(self):
+        return (f"Admission: {sum(self.inflight.values())} of {self.max_inflight} slots in use, "
+                f"{self.waiting} of {self.max_queue} queued from {len(self.queues)} users, "
+                f"{self.admitted} admitted, shed {self.shed['queue_full']} (queue full) "
+                f"and {self.shed['timeout']} (waited over {self.queue_timeout:g} s)")
+
+if "admission" not in pn.state.cache:
+    pn.state.cache["admission"] = AdmissionController(MAX_INFLIGHT, MAX_QUEUE, MAX_INFLIGHT_PER_USER, QUEUE_TIMEOUT)
+admission = pn.state.cache["admission"]
+
+def current_user():
+    """
+    Whom a request is queued for: the login name with authentication, else the client address
+    a proxy forwarded, else the browser session. The connection's own address is not used,
+    since behind NAT, Docker or a proxy it is the same for everyone.
+    """
+    if pn.state.user:
+        return pn.state.user
+    context = pn.state.curdoc.session_context if pn.state.curdoc else None
+    if context is None:
+        return "anonymous"
+    request = context.request
+    forwarded = request.headers.get("X-Forwarded-For", "") if request is not None else ""
+    if forwarded.split(",")[0].strip():
+        return forwarded.split(",")[0].strip()
+    return context.id
+
+# -------------------------------------------------------------------
+# Session Store (shared/llm_common.py)
+# -------------------------------------------------------------------
+session_store = setup_session_store(SESSION_DIR, SESSION_FSYNC_INTERVAL)
 
 # Define widgets
-chat_history = pn.pane.Markdown("### Chat History\n\n", width=600, height=400)
+chat_log = MessageLog("### Chat History", window=CHAT_WINDOW, width=600, height=400, scroll=True, auto_scroll_limit=100)
 chat_history_container = pn.Row(
-    chat_history,
+    chat_log,
     sizing_mode='stretch_both',
     css_classes=['scrollable']
 )
@@ -40,40 +237,117 @@ user_input = pn.widgets.TextInput(
 send_button = pn.widgets.Button(name='Send', button_type='primary')
 clear_button = pn.widgets.Button(name='Clear', button_type='warning')
 
-# Initialize conversation history
+# Initialize conversation history. `panel serve` runs this script once per browser session,
+# so the conversation and the widgets are per session; only pn.state.cache is shared.
 conversation = []
+# One reply at a time per session, since each request sends the whole conversation
+reply_lock = asyncio.Lock()
+# The stored session this browser session writes to; "count" numbers its messages
+session = {"id": current_session_id(), "count": 0}
+
+def persist_message(message):
+    if session_store is not None:
+        session_store.append(session["id"], {"kind": "message", "n": session["count"], "message": message})
+    session["count"] += 1
 
-def send_message(event=None):
+def show_message(message):
+    if message["role"] == "user":
+        chat_log.append(f"> **🧑 You:** {message['content']}")
+    else:
+        chat_log.append(f"> **🤖 Bot:** {message['content']}")
+
+def resume_session():
+    """Loads the tail of a stored session into the conversation and the chat pane."""
+    if session_store is None:
+        return
+    _, records = session_store.tail(session["id"], limit=SESSION_RESUME_MESSAGES)
+    if not records:
+        return
+    session["count"] = records[-1]["n"] + 1
+    if records[0]["n"]:
+        chat_log.append(f"*Resumed session: {records[0]['n']} earlier messages are not loaded.*")
+    for record in records:
+        conversation.append(record["message"])
+        show_message(record["message"])
+
+resume_session()
+
+async def stream_completion(label, **params):
+    """
+    Calls the chat completions API and returns the reply text.
+    With STREAM_REPLIES the reply is rendered in the chat pane under `label` as tokens
+    arrive; the preview is removed again and the caller appends the final reply.
+    Requests allowed by LLM_CACHE are answered from the completion cache when possible.
+    """
+    if not STREAM_REPLIES:
+        response, _ = await cached_create(client, **params)
+        return response.choices[0].message.content.strip()
+
+    with StreamPreview(chat_log, label) as preview:
+        response, _ = await cached_create(client, on_content=preview, **params)
+    return response.choices[0].message.content.strip()
+
+async def send_message(event=None):
     user_msg = user_input.value.strip()
     if not user_msg:
         pn.state.notifications.warning("Please enter a message.")
         return
+    if reply_lock.locked():
+        pn.state.notifications.warning("Please wait for the current reply to finish.")
+        return
 
     # Append user message with avatar
-    chat_history.object += f"> **🧑 You:** {user_msg}\n\n"
+    chat_log.append(f"> **🧑 You:** {user_msg}")
     user_input.value = ""
 
     # Update conversation history
     conversation.append({"role": "user", "content": user_msg})
 
     try:
-        # Make API call to OpenAI with conversation history
-        completion = client.chat.completions.create(
-            model="gpt-4",
-            messages=conversation,
-        )
-        bot_reply = completion.choices[0].message.content.strip()
+        async with reply_lock:
+            user = current_user()
+            # Wait for a slot in the shared pool, showing the queue while waiting
+            waiting_pane = None
+            if admission.must_wait(user):
+                waiting_pane = chat_log.append(
+                    f"> **🤖 Bot:** ⏳ The server is busy; waiting for a free slot ({admission.waiting} requests queued)..."
+                )
+            try:
+                await admission.acquire(user)
+            finally:
+                if waiting_pane is not None:
+                    chat_log.remove(waiting_pane)
+            # Admitted, so the message is part of the conversation now
+            persist_message(conversation[-1])
+            try:
+                # Make API call to OpenAI with conversation history
+                bot_reply = await stream_completion(
+                    "> **🤖 Bot:**",
+                    model="gpt-4",
+                    messages=conversation,
+                )
+            finally:
+                admission.release(user)
         # Append bot reply with avatar
-        chat_history.object += f"> **🤖 Bot:** {bot_reply}\n\n"
+        chat_log.append(f"> **🤖 Bot:** {bot_reply}")
         # Update conversation history
         conversation.append({"role": "assistant", "content": bot_reply})
+        persist_message(conversation[-1])
+    except ServerBusy:
+        # Shed: take the message back so it can simply be sent again
+        conversation.pop()
+        user_input.value = user_msg
+        chat_log.append("> **🤖 Bot:** The server is busy right now. Your message was not sent; please try again in a moment.")
     except OpenAIError as e:
         pn.state.notifications.error(f"OpenAI API error: {e}")
 
 def clear_chat(event):
     global conversation
     conversation = []
-    chat_history.object = "### Chat History\n\n"
+    if session_store is not None:
+        session_store.append(session["id"], {"kind": "clear"})
+    session["count"] = 0
+    chat_log.clear()
 
 # Bind events
 send_button.on_click(send_message)
@@ -87,6 +361,8 @@ layout = pn.Column(
     sizing_mode='stretch_width'
 )
 
+layout = stats_tab(layout, "Chat", [admission.stats_markdown])
+
 layout.servable()
 
 # For direct running
@@ -0,0 +1,687 @@
+"""
+Helpers shared by the Panel LLM apps (SimpleChat, LlmConversation, LlmConsistency and
+LlmCliTool): Prometheus metrics of completion requests, the on-disk completion cache, the
+rate-limited request scheduler, cached (and streamed) completion requests, the JSONL
+session store, the chat transcript pane and the Stats tab.
+
+The settings they have in common (METRICS_PORT, SHOW_STATS, LLM_CACHE*, RATE_LIMIT_*) are
+read from the environment here. `panel serve` runs an app's script once per browser
+session, so the process-wide objects set up here live in pn.state.cache like the apps'
+own. Each app's image copies this directory to /opt/shared (see its dockerfile); in a
+checkout the apps find it next to them.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import panel as pn
+from openai import APIConnectionError, InternalServerError, RateLimitError
+from openai.types.chat import ChatCompletion
+from prometheus_client import Histogram, start_http_server
+from pydantic import ValidationError
+
+# -------------------------------------------------------------------
+# Configuration / Environment Variables (the same for every app)
+# -------------------------------------------------------------------
+# Prometheus metrics on http://<host>:METRICS_PORT/metrics (0 disables) and a Stats tab in the UI
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+SHOW_STATS = os.getenv('SHOW_STATS', '1') != '0'
+
+# Opt-in on-disk cache of completions: LLM_CACHE=deterministic caches temperature-0 requests, =all every request
+LLM_CACHE = os.getenv('LLM_CACHE', 'off')
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'llm_completion_cache.sqlite'))
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_MB', '100')) * 1024 * 1024
+
+# Request scheduling: starting requests/tokens per minute (replaced by the API's x-ratelimit-* headers) and retries
+RATE_LIMIT_RPM = int(os.getenv('RATE_LIMIT_RPM', '500'))
+RATE_LIMIT_TPM = int(os.getenv('RATE_LIMIT_TPM', '30000'))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv('RATE_LIMIT_MAX_RETRIES', '6'))
+
+# -------------------------------------------------------------------
+# Metrics
+# -------------------------------------------------------------------
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 131072)
+
+def create_metrics():
+    """Histograms of completion requests (Prometheus registers each name once, so call it once per process)."""
+    return {
+        "llm_latency": Histogram("llm_request_seconds", "Duration of chat completion requests",
+                                 ["model"], buckets=LATENCY_BUCKETS),
+        "llm_ttft": Histogram("llm_time_to_first_token_seconds", "Time until the first streamed token",
+                              ["model"], buckets=LATENCY_BUCKETS),
+        "prompt_tokens": Histogram("llm_prompt_tokens", "Prompt tokens per request",
+                                   ["model"], buckets=TOKEN_BUCKETS),
+        "completion_tokens": Histogram("llm_completion_tokens", "Completion tokens per request",
+                                       ["model"], buckets=TOKEN_BUCKETS),
+    }
+
+def setup_metrics(create_extra=None, port=METRICS_PORT):
+    """
+    The process-wide metrics: the completion histograms plus the app's own from `create_extra()`.
+    The first session of the process creates them and serves them on `port` (0 disables).
+    """
+    if "metrics" not in pn.state.cache:
+        pn.state.cache["metrics"] = {**create_metrics(), **(create_extra() if create_extra else {})}
+        if port:
+            try:
+                start_http_server(port)
+            except OSError as e:
+                print(f"Could not serve /metrics on port {port}: {e}")
+    return pn.state.cache["metrics"]
+
+def observe_completion(model, started, first_token_at=None, usage=None):
+    """Records latency, time-to-first-token and token usage of one completion request."""
+    metrics = pn.state.cache["metrics"]
+    metrics["llm_latency"].labels(model=model).observe(time.perf_counter() - started)
+    if first_token_at is not None:
+        metrics["llm_ttft"].labels(model=model).observe(first_token_at - started)
+    if usage is not None:
+        metrics["prompt_tokens"].labels(model=model).observe(usage.prompt_tokens)
+        metrics["completion_tokens"].labels(model=model).observe(usage.completion_tokens)
+
+def metrics_markdown():
+    """Count, mean and total of every histogram as a Markdown table (gauges and counters are skipped)."""
+    rows = []
+    for histogram in pn.state.cache["metrics"].values():
+        for metric in histogram.collect():
+            totals = {}
+            for sample in metric.samples:
+                if sample.name.endswith(("_count", "_sum")):
+                    labels = ", ".join(f"{k}={v}" for k, v in sorted(sample.labels.items()))
+                    totals.setdefault(labels, {})[sample.name.rsplit("_", 1)[1]] = sample.value
+            for labels, values in totals.items():
+                count, total = values.get("count", 0), values.get("sum", 0)
+                mean = total / count if count else 0
+                rows.append(f"| {metric.name} | {labels} | {count:.0f} | {mean:.3f} | {total:.3f} |")
+    if not rows:
+        return "No requests recorded yet."
+    return "| Metric | Labels | Count | Mean | Total |\n|---|---|---|---|---|\n" + "\n".join(rows)
+
+# -------------------------------------------------------------------
+# Completion Cache
+# -------------------------------------------------------------------
+class CompletionCache:
+    """
+    Opt-in on-disk cache of chat completions in SQLite, keyed by a hash of the request
+    parameters (model, messages, temperature, tools, ...). Once the stored results exceed
+    `max_bytes`, the least recently used ones are evicted. The file can be shared by
+    several apps and processes; the hit/miss counters are per process. `mode` is the
+    LLM_CACHE setting: "deterministic" caches temperature-0 requests, "all" every request.
+    """
+
+    def __init__(self, path, max_bytes, mode="deterministic"):
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)")
+        self._db.commit()
+
+    @staticmethod
+    def key(params):
+        # Streaming options change how the reply is delivered, not the reply itself
+        relevant = {k: v for k, v in params.items() if k not in ("stream", "stream_options")}
+        return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, params):
+        """The stored value for these request parameters, or None."""
+        key = self.key(params)
+        with self._lock:
+            row = self._db.execute("SELECT value FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE completions SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, params, value):
+        """Stores a JSON-serializable value and evicts least recently used entries beyond max_bytes."""
+        data = json.dumps(value)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                             (self.key(params), data, len(data), time.time()))
+            excess = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0] - self.max_bytes
+            if excess > 0:
+                evicted = []
+                for key, size in self._db.execute("SELECT key, size FROM completions ORDER BY last_used"):
+                    if excess <= 0:
+                        break
+                    evicted.append((key,))
+                    excess -= size
+                self._db.executemany("DELETE FROM completions WHERE key = ?", evicted)
+            self._db.commit()
+
+    def stats_markdown(self):
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        return (f"Completion cache ({self.mode}): {entries} entries, {size / 1024 / 1024:.1f} of "
+                f"{self.max_bytes / 1024 / 1024:.0f} MB, {self.hits} hits, {self.misses} misses")
+
+def setup_completion_cache(mode=LLM_CACHE, path=LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES):
+    """The process-wide completion cache, or None unless `mode` (LLM_CACHE) is "deterministic" or "all"."""
+    if "completion_cache" not in pn.state.cache:
+        pn.state.cache["completion_cache"] = (
+            CompletionCache(path, max_bytes, mode) if mode in ("deterministic", "all") else None
+        )
+    return pn.state.cache["completion_cache"]
+
+def cacheable(params):
+    """Whether a request may be answered from the completion cache under its mode."""
+    completion_cache = pn.state.cache.get("completion_cache")
+    if completion_cache is None:
+        return False
+    return completion_cache.mode == "all" or params.get("temperature") == 0
+
+# -------------------------------------------------------------------
+# Request Scheduler
+# -------------------------------------------------------------------
+RETRY_BASE_DELAY = 1.0  # seconds, doubled per attempt
+RETRY_MAX_DELAY = 60.0
+COMPLETION_TOKEN_ESTIMATE = 500  # completion tokens assumed for TPM accounting when max_tokens isn't set
+
+class TokenBucket:
+    """Refills continuously at `per_minute` units per minute, up to one minute's worth."""
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.per_minute, self.available + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` units are available (0 if they are available now)."""
+        self.refill()
+        missing = min(amount, self.per_minute) - self.available
+        return max(missing, 0) * 60 / self.per_minute
+
+def parse_reset(value):
+    """Parses OpenAI's x-ratelimit-reset-* durations such as "1s", "6m0s" or "120ms" into seconds."""
+    seconds = 0.0
+    for number, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value or ""):
+        seconds += float(number) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+class RequestScheduler:
+    """
+    Process-wide admission control for the chat completion requests of `client`.
+
+    Requests wait for both a request and a token budget (token buckets sized by
+    RATE_LIMIT_RPM / RATE_LIMIT_TPM). The limits and remaining budget reported in the
+    x-ratelimit-* response headers replace the configured values as soon as they are seen.
+    Rate limit, connection and server errors are retried with jittered exponential backoff,
+    honouring Retry-After; a 429 also pauses every other request until the server's reset time.
+    """
+
+    def __init__(self, client, rpm=RATE_LIMIT_RPM, tpm=RATE_LIMIT_TPM, max_retries=RATE_LIMIT_MAX_RETRIES):
+        # The scheduler does its own retries, so the client's built-in ones are switched off for its requests
+        self.client = client.with_options(max_retries=0)
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.paused_until = 0.0
+        self.retries = 0
+        self.waited = 0.0
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def estimate_tokens(params):
+        """Rough prompt size (4 characters per token) plus the completion allowance."""
+        prompt = sum(len(str(message.get("content") or "")) for message in params.get("messages", []))
+        return prompt // 4 + params.get("max_tokens", COMPLETION_TOKEN_ESTIMATE) * params.get("n", 1)
+
+    async def acquire(self, estimated_tokens):
+        # One waiter at a time, so requests are admitted in arrival order
+        async with self._lock:
+            while True:
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens),
+                           self.paused_until - time.monotonic())
+                if wait <= 0:
+                    break
+                self.waited += wait
+                await asyncio.sleep(wait)
+            self.requests.available -= 1
+            self.tokens.available -= estimated_tokens
+
+    def update_from_headers(self, headers):
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit and limit.isdigit():
+                bucket.per_minute = int(limit)
+            if remaining and remaining.isdigit():
+                bucket.refill()
+                bucket.available = min(bucket.available, int(remaining))
+
+    def retry_delay(self, error, attempt):
+        """Retry-After if the server sent one, else exponential backoff with full jitter."""
+        headers = error.response.headers if getattr(error, "response", None) is not None else {}
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after", "").replace(".", "", 1).isdigit():
+            return float(headers["retry-after"])
+        if headers.get("x-ratelimit-reset-requests") or headers.get("x-ratelimit-reset-tokens"):
+            return max(parse_reset(headers.get("x-ratelimit-reset-requests")),
+                       parse_reset(headers.get("x-ratelimit-reset-tokens")))
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    def settle(self, params, usage):
+        """Corrects the token estimate of a finished request by what it actually used."""
+        if usage is not None:
+            self.tokens.available += self.estimate_tokens(params) - usage.total_tokens
+
+    async def create(self, **params):
+        """
+        Runs client.chat.completions.create(**params) within the limits, retrying transient failures.
+        A stream is returned as soon as it starts; the caller settles it with its usage once it ends.
+        """
+        estimated = self.estimate_tokens(params)
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(estimated)
+            try:
+                raw = await self.client.chat.completions.with_raw_response.create(**params)
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                # An exhausted quota won't come back by waiting
+                if attempt == self.max_retries or getattr(e, "code", None) == "insufficient_quota":
+                    raise
+                delay = self.retry_delay(e, attempt)
+                if isinstance(e, RateLimitError):
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                    self.update_from_headers(e.response.headers)
+                self.retries += 1
+                self.waited += delay
+                await asyncio.sleep(delay)
+                continue
+            self.update_from_headers(raw.headers)
+            response = raw.parse()
+            if not params.get("stream"):
+                self.settle(params, response.usage)
+            return response
+
+    def stats_markdown(self):
+        return (f"Scheduler: {self.requests.per_minute} requests/min, {self.tokens.per_minute} tokens/min, "
+                f"{self.retries} retries, {self.waited:.1f}s spent waiting")
+
+def setup_request_scheduler(client):
+    """The process-wide request scheduler for `client`, limited by the RATE_LIMIT_* environment variables."""
+    if "request_scheduler" not in pn.state.cache:
+        pn.state.cache["request_scheduler"] = RequestScheduler(client)
+    return pn.state.cache["request_scheduler"]
+
+# -------------------------------------------------------------------
+# Completion Requests
+# -------------------------------------------------------------------
+async def cached_create(client, on_content=None, **params):
+    """
+    Creates a chat completion with `client` (an AsyncOpenAI client, or a RequestScheduler to
+    stay within its limits) and records the request in the metrics. Requests allowed by
+    LLM_CACHE are answered from the completion cache when possible. Returns the
+    ChatCompletion and whether it came from the cache.
+
+    With `on_content` the completion is streamed: on_content(text) is called with each piece
+    of content as it arrives, and the chunks, tool calls included, are assembled into the
+    returned ChatCompletion.
+    """
+    completion_cache = pn.state.cache.get("completion_cache")
+    use_cache = cacheable(params)
+    if use_cache:
+        cached = completion_cache.get(params)
+        if cached is not None:
+            try:
+                return ChatCompletion.model_validate(cached), True
+            except ValidationError:
+                pass  # stored by an older version in another format; ask again and replace it
+
+    create = client.create if isinstance(client, RequestScheduler) else client.chat.completions.create
+    started = time.perf_counter()
+    if on_content is None:
+        response = await create(**params)
+        observe_completion(params["model"], started, usage=response.usage)
+    else:
+        stream_params = dict(params, stream=True, stream_options={"include_usage": True})
+        response, first_token_at = await collect_stream(await create(**stream_params), params["model"], on_content)
+        if isinstance(client, RequestScheduler):
+            client.settle(stream_params, response.usage)
+        observe_completion(params["model"], started, first_token_at, response.usage)
+    if use_cache:
+        completion_cache.put(params, response.model_dump(mode="json"))
+    return response, False
+
+async def collect_stream(stream, model, on_content):
+    """Assembles a completion stream into a ChatCompletion; returns it and the time of its first token."""
+    completion = {"id": "", "created": 0, "model": model}
+    content_parts = []
+    tool_calls = {}  # stream index -> tool call being assembled
+    finish_reason = None
+    usage = None
+    first_token_at = None
+    async for chunk in stream:
+        completion.update(id=chunk.id, created=chunk.created, model=chunk.model)
+        if chunk.usage:
+            usage = chunk.usage.model_dump()
+        if not chunk.choices:
+            continue
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+        delta = chunk.choices[0].delta
+        if first_token_at is None and (delta.content or delta.tool_calls):
+            first_token_at = time.perf_counter()
+        if delta.content:
+            content_parts.append(delta.content)
+            on_content(delta.content)
+        for tool_delta in delta.tool_calls or []:
+            tool_call = tool_calls.setdefault(tool_delta.index, {
+                "id": None, "type": "function", "function": {"name": "", "arguments": ""}
+            })
+            if tool_delta.id:
+                tool_call["id"] = tool_delta.id
+            if tool_delta.function:
+                tool_call["function"]["name"] += tool_delta.function.name or ""
+                tool_call["function"]["arguments"] += tool_delta.function.arguments or ""
+    message = {"role": "assistant", "content": "".join(content_parts)}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[index] for index in sorted(tool_calls)]
+    response = ChatCompletion.model_validate({
+        **completion, "object": "chat.completion", "usage": usage,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason or "stop"}],
+    })
+    return response, first_token_at
+
+# -------------------------------------------------------------------
+# Session Store
+# -------------------------------------------------------------------
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+class SessionStore:
+    """
+    Append-only JSONL log per session: one "message" record per message, "summary" records
+    for rolling summaries and a "clear" record when the chat is cleared. Each record is
+    flushed as soon as it is appended, so a crashed process loses nothing; fsync runs in
+    the background for every file written since the last round, so a crashed host loses at
+    most `fsync_interval` seconds (0 syncs every record). Sessions are read back from the
+    end of the file, so resuming a long session only reads the tail it needs.
+    """
+
+    READ_BLOCK = 64 * 1024
+
+    def __init__(self, directory, fsync_interval, max_open=128):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.max_open = max_open
+        self._files = OrderedDict()  # session id -> open file, least recently used first
+        self._dirty = set()
+        self._lock = threading.Lock()
+        if fsync_interval > 0:
+            threading.Thread(target=self._sync_loop, daemon=True).start()
+
+    def path(self, session_id):
+        return os.path.join(self.directory, f"{session_id}.jsonl")
+
+    def _open(self, session_id):
+        f = self._files.get(session_id)
+        if f is not None:
+            self._files.move_to_end(session_id)
+            return f
+        f = open(self.path(session_id), "a+b")
+        if f.tell():
+            # A line cut short by a crash would swallow the next record, so start a fresh one
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        self._files[session_id] = f
+        while len(self._files) > self.max_open:
+            old_id, old = self._files.popitem(last=False)
+            if old_id in self._dirty:
+                self._dirty.discard(old_id)
+                os.fsync(old.fileno())
+            old.close()
+        return f
+
+    def append(self, session_id, record):
+        line = json.dumps(dict(record, t=round(time.time(), 3))).encode() + b"\n"
+        with self._lock:
+            f = self._open(session_id)
+            f.write(line)
+            f.flush()
+            if self.fsync_interval > 0:
+                self._dirty.add(session_id)
+            else:
+                os.fsync(f.fileno())
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            self.sync()
+
+    def sync(self):
+        """Fsyncs every file written since the last call, without holding up appends meanwhile."""
+        with self._lock:
+            fds = [os.dup(self._files[session_id].fileno()) for session_id in self._dirty if session_id in self._files]
+            self._dirty = set()
+        for fd in fds:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def reverse_records(self, session_id):
+        """Records of a session, newest first, read block by block from the end of the file."""
+        try:
+            f = open(self.path(session_id), "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            position = f.seek(0, os.SEEK_END)
+            remainder = b""
+            while position > 0:
+                size = min(self.READ_BLOCK, position)
+                position -= size
+                f.seek(position)
+                lines = (f.read(size) + remainder).split(b"\n")
+                remainder = lines.pop(0)  # may continue in the previous block
+                for line in reversed(lines):
+                    record = self._parse(line)
+                    if record is not None:
+                        yield record
+            record = self._parse(remainder)
+            if record is not None:
+                yield record
+
+    @staticmethod
+    def _parse(line):
+        if not line.strip():
+            return None
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            return None  # cut short by a crash
+
+    def tail(self, session_id, limit=None):
+        """
+        What resuming a session needs: the latest summary record (or None) and the message
+        records since the chat was last cleared, oldest first. With a summary only the
+        messages from its "upto" on are read; without one at most `limit` messages.
+        """
+        summary, messages = None, []
+        for record in self.reverse_records(session_id):
+            if record["kind"] == "clear":
+                break
+            if record["kind"] == "summary":
+                summary = summary or record
+            elif record["kind"] == "message":
+                if summary is not None and record["n"] < summary["upto"]:
+                    break
+                messages.append(record)
+                if summary is None and limit is not None and len(messages) >= limit:
+                    break
+        messages.reverse()
+        return summary, messages
+
+def setup_session_store(directory, fsync_interval):
+    """The process-wide session store, or None when `directory` (SESSION_DIR) is empty."""
+    if directory and "session_store" not in pn.state.cache:
+        pn.state.cache["session_store"] = SessionStore(directory, fsync_interval)
+    return pn.state.cache.get("session_store")
+
+def current_session_id():
+    """The session id from the ?session= URL parameter, or a new one that is put into the URL."""
+    requested = pn.state.session_args.get("session", [b""])[0].decode(errors="replace") if pn.state.session_args else ""
+    if SESSION_ID_PATTERN.match(requested):
+        return requested
+    session_id = uuid.uuid4().hex
+    if pn.state.location is not None:
+        pn.state.location.update_query(session=session_id)
+    return session_id
+
+# -------------------------------------------------------------------
+# Chat Rendering
+# -------------------------------------------------------------------
+STREAM_UI_INTERVAL = 0.1  # seconds between chat pane refreshes while streaming
+
+class MessageLog:
+    """
+    Transcript rendered as one Markdown pane per message.
+
+    Appending a message only sends the new pane to the browser instead of re-sending and
+    re-rendering the whole transcript. At most `window` messages stay rendered; older ones
+    are dropped from the page and can be brought back with the "Show earlier" button.
+    """
+
+    def __init__(self, title=None, window=200, **params):
+        self.window = window
+        self.shown_limit = window
+        self.panes = []  # every message of the session, oldest first
+        self.first_shown = 0
+        self.show_earlier = pn.widgets.Button(name="Show earlier messages", button_type="light", visible=False)
+        self.show_earlier.on_click(self._show_earlier)
+        self.body = pn.Column(sizing_mode="stretch_width")
+        self.layout = pn.Column(self.show_earlier, self.body, **params)
+        if title:
+            self.layout.insert(0, title)
+
+    def __panel__(self):
+        return self.layout
+
+    def append(self, text):
+        """Adds a message and returns its pane, which can be updated in place while streaming."""
+        pane = pn.pane.Markdown(text, sizing_mode="stretch_width")
+        self.panes.append(pane)
+        if len(self.panes) - self.first_shown > self.shown_limit:
+            self.first_shown = len(self.panes) - self.shown_limit
+            self._render()
+        else:
+            self.body.append(pane)
+        return pane
+
+    def remove(self, pane):
+        """Removes a message; one that is gone already (the log was cleared meanwhile) is ignored."""
+        if pane not in self.panes:
+            return
+        index = self.panes.index(pane)
+        self.panes.remove(pane)
+        if index < self.first_shown:
+            self.first_shown -= 1
+        else:
+            self.body.remove(pane)
+
+    def clear(self):
+        self.panes = []
+        self.first_shown = 0
+        self.shown_limit = self.window
+        self._render()
+
+    def _show_earlier(self, event=None):
+        self.first_shown = max(0, self.first_shown - self.window)
+        self.shown_limit = len(self.panes) - self.first_shown + self.window
+        self._render()
+
+    def _render(self):
+        self.body.objects = self.panes[self.first_shown:]
+        self.show_earlier.visible = self.first_shown > 0
+        self.show_earlier.name = f"Show earlier messages ({self.first_shown} hidden)"
+
+class StreamPreview:
+    """
+    Shows a reply in a MessageLog under `label` while it streams in. Call it with each piece
+    of content (it fits cached_create's on_content); the pane is refreshed at most every
+    `interval` seconds and removed when the `with` block ends, so the caller can append the
+    final reply.
+    """
+
+    def __init__(self, message_log, label, interval=STREAM_UI_INTERVAL):
+        self.message_log = message_log
+        self.label = label
+        self.interval = interval
+        self.parts = []
+        self.pane = None
+        self.last_render = 0.0
+
+    def __call__(self, text):
+        self.parts.append(text)
+        now = time.monotonic()
+        if now - self.last_render >= self.interval:
+            text = f"{self.label} {''.join(self.parts)} ▌"
+            if self.pane is None:
+                self.pane = self.message_log.append(text)
+            else:
+                self.pane.object = text
+            self.last_render = now
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pane is not None:
+            self.message_log.remove(self.pane)
+            self.pane = None
+
+# -------------------------------------------------------------------
+# Stats Tab
+# -------------------------------------------------------------------
+def stats_tab(layout, label, extra_markdown_fns=()):
+    """
+    Puts `layout` into a tab named `label` next to a Stats tab, unless SHOW_STATS=0. The
+    Stats tab shows the metrics, the Markdown of each of `extra_markdown_fns` and the
+    completion cache, refreshed whenever a tab is opened and by its Refresh button.
+    """
+    if not SHOW_STATS:
+        return layout
+    stats_pane = pn.pane.Markdown(sizing_mode="stretch_width")
+    refresh_stats_button = pn.widgets.Button(name="Refresh", button_type="default")
+
+    def refresh_stats(event=None):
+        parts = [metrics_markdown()] + [markdown() for markdown in extra_markdown_fns]
+        completion_cache = pn.state.cache.get("completion_cache")
+        if completion_cache is not None:
+            parts.append(completion_cache.stats_markdown())
+        stats_pane.object = "\n\n".join(parts)
+
+    refresh_stats()
+    refresh_stats_button.on_click(refresh_stats)
+    stats_layout = pn.Column("# Stats (this server process)", refresh_stats_button, stats_pane, sizing_mode="stretch_width")
+    tabs = pn.Tabs((label, layout), ("Stats", stats_layout))
+    tabs.param.watch(refresh_stats, "active")
+    return tabs
@@ -0,0 +1,144 @@
+import os
+import sys
+
+import panel as pn
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import llm_common  # noqa: E402
+
+
+@pytest.fixture
+def fresh_cache():
+    pn.state.cache.pop("completion_cache", None)
+    yield
+    pn.state.cache.pop("completion_cache", None)
+
+
+@pytest.mark.parametrize("mode, cached_temperatures", [("off", []), ("deterministic", [0]), ("all", [0, 1])])
+def test_cache_mode_decides_what_is_cacheable(tmp_path, fresh_cache, mode, cached_temperatures):
+    llm_common.setup_completion_cache(mode, str(tmp_path / "cache.sqlite"), 1024 * 1024)
+    assert [t for t in (0, 1) if llm_common.cacheable({"temperature": t})] == cached_temperatures
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = llm_common.CompletionCache(str(tmp_path / "cache.sqlite"), max_bytes=250)
+    for n in range(3):
+        cache.put({"model": "m", "n": n}, "x" * 100)
+    cache.get({"model": "m", "n": 1})
+    cache.put({"model": "m", "n": 3}, "x" * 100)
+    assert [cache.get({"model": "m", "n": n}) is not None for n in range(4)] == [False, True, False, True]
+
+
+def test_session_tail_starts_after_the_last_clear_and_summary(tmp_path):
+    store = llm_common.SessionStore(str(tmp_path), fsync_interval=0)
+    store.append("session-1", {"kind": "message", "n": 0, "message": {"content": "before clear"}})
+    store.append("session-1", {"kind": "clear"})
+    for n in range(6):
+        store.append("session-1", {"kind": "message", "n": n, "message": {"content": str(n)}})
+    store.append("session-1", {"kind": "summary", "text": "S", "upto": 4})
+    summary, messages = store.tail("session-1")
+    assert summary["text"] == "S"
+    assert [record["n"] for record in messages] == [4, 5]
+
+
+def test_removing_a_message_after_clear_is_ignored():
+    log = llm_common.MessageLog(window=2)
+    pane = log.append("streaming...")
+    log.clear()
+    log.remove(pane)
+    kept = log.append("after clear")
+    log.remove(pane)
+    assert log.panes == [kept]
+
+
+def test_scheduler_retries_rate_limited_requests():
+    import asyncio
+    import types
+
+    from openai import RateLimitError
+
+    calls = []
+
+    async def create(**params):
+        calls.append(params)
+        if len(calls) == 1:
+            response = types.SimpleNamespace(status_code=429, headers={"retry-after-ms": "10"}, request=None)
+            raise RateLimitError("rate limited", response=response, body=None)
+        usage = types.SimpleNamespace(total_tokens=10)
+        return types.SimpleNamespace(headers={"x-ratelimit-limit-requests": "60"},
+                                     parse=lambda: types.SimpleNamespace(usage=usage))
+
+    completions = types.SimpleNamespace(with_raw_response=types.SimpleNamespace(create=create))
+    client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=completions))
+    client.with_options = lambda **options: client
+    scheduler = llm_common.RequestScheduler(client, rpm=100, tpm=10000, max_retries=2)
+
+    asyncio.run(scheduler.create(model="m", messages=[{"role": "user", "content": "hi"}]))
+    assert len(calls) == 2
+    assert scheduler.retries == 1
+    assert scheduler.requests.per_minute == 60
+    assert llm_common.parse_reset("6m0.5s") == 360.5
+
+
+def test_cached_create_assembles_streams_and_caches_them(tmp_path, fresh_cache):
+    import asyncio
+    import types
+
+    from openai.types.chat import ChatCompletionChunk
+
+    def chunk(delta=None, usage=None):
+        choices = [{"index": 0, "delta": delta, "finish_reason": None}] if delta else []
+        return ChatCompletionChunk.model_validate({"id": "c1", "object": "chat.completion.chunk", "created": 1,
+                                                   "model": "m", "choices": choices, "usage": usage})
+
+    chunks = [
+        chunk({"role": "assistant", "content": "Hel"}),
+        chunk({"content": "lo"}),
+        chunk({"tool_calls": [{"index": 0, "id": "t1", "type": "function",
+                               "function": {"name": "run", "arguments": '{"a"'}}]}),
+        chunk({"tool_calls": [{"index": 0, "function": {"arguments": ": 1}"}}]}),
+        chunk(usage={"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}),
+    ]
+    calls = []
+
+    async def create(**params):
+        calls.append(params)
+
+        async def stream():
+            for c in chunks:
+                yield c
+        return stream()
+
+    client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+    llm_common.setup_metrics(port=0)
+    llm_common.setup_completion_cache("all", str(tmp_path / "cache.sqlite"), 1024 * 1024)
+    streamed = []
+
+    response, cached = asyncio.run(llm_common.cached_create(client, on_content=streamed.append, model="m", messages=[]))
+    assert (streamed, cached, calls[0]["stream"]) == (["Hel", "lo"], False, True)
+    assert response.choices[0].message.content == "Hello"
+    assert response.choices[0].message.tool_calls[0].function.arguments == '{"a": 1}'
+    assert response.usage.total_tokens == 5
+
+    response, cached = asyncio.run(llm_common.cached_create(client, model="m", messages=[]))
+    assert cached and len(calls) == 1
+    assert response.choices[0].message.content == "Hello"
+
+
+def test_stream_preview_is_removed_when_the_reply_is_done():
+    log = llm_common.MessageLog()
+    log.append("question")
+    with llm_common.StreamPreview(log, "Bot:", interval=0) as preview:
+        preview("Hel")
+        preview("lo")
+        assert log.panes[-1].object == "Bot: Hello ▌"
+    assert [pane.object for pane in log.panes] == ["question"]
+
+
+def test_stats_tab_shows_the_extra_markdown():
+    llm_common.setup_metrics(port=0)
+    tabs = llm_common.stats_tab(pn.Column("app"), "Chat", [lambda: "Scheduler: fine"])
+    assert isinstance(tabs, pn.Tabs) and len(tabs) == 2
+    assert "Scheduler: fine" in tabs[1][2].object